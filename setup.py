@@ -35,6 +35,9 @@ setup(
         'pillow',
         'urwid',
     ],
+    extras_require={
+        'xlib': ['python-xlib'],
+    },
     entry_points = {
         'console_scripts': ['walliser = walliser.cli:main'],
     }
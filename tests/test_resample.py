@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pytest
+from PIL import Image, ImageChops
+
+from walliser import resample
+from walliser.resample import TiledResizer
+
+
+@pytest.fixture(scope="module")
+def resizer():
+    resizer = TiledResizer(2, min_pixels=1)
+    yield resizer
+    resizer.shutdown()
+
+def noise(mode, size, seed=0):
+    """Worst case for strip seams: no two neighbouring pixels alike."""
+    rng = random.Random(seed)
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    data = bytes(rng.randrange(256) for _ in range(size[0] * size[1] * bands))
+    return Image.frombytes(mode, size, data)
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+@pytest.mark.parametrize("size, box", [
+    ((120, 50), (0, 0, 300, 200)),              # downscale
+    ((97, 61), (10.5, 7.25, 290.75, 193.5)),    # fractional crop
+    ((400, 333), (20.3, 11.7, 180.1, 150.9)),   # upscale
+    ((300, 7), (0, 0.5, 300, 199.5)),           # fewer rows than strips
+])
+def test_tiled_resize_matches_single_pass(resizer, mode, size, box):
+    img = noise(mode, (300, 200))
+    expected = img.resize(size, resample=Image.LANCZOS, box=box)
+    result = resizer.resize(img, size, box)
+    assert result.mode == expected.mode
+    assert result.size == expected.size
+    # Strips compute filter coefficients from slightly different float
+    # offsets, which may flip the rounding of a value.
+    tolerance = 1
+    if mode == "RGBA":
+        # Colours are resized premultiplied by alpha, compare them that way
+        # so rounding differences aren't amplified by transparency. Both
+        # conversions round once more.
+        result, expected = result.convert("RGBa"), expected.convert("RGBa")
+        tolerance = 2
+    extrema = ImageChops.difference(result, expected).getextrema()
+    if mode == "L":
+        extrema = [extrema]
+    assert max(high for _, high in extrema) <= tolerance
+
+def test_concurrent_resizes_share_one_pool(monkeypatch):
+    pools = []
+    class SlowToStart(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            time.sleep(.1)  # let other threads catch up
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+    monkeypatch.setattr(resample, "ProcessPoolExecutor", SlowToStart)
+    resizer = TiledResizer(2, min_pixels=1)
+    img = noise("RGB", (120, 80))
+    expected = img.resize((40, 30), resample=Image.LANCZOS)
+    try:
+        with ThreadPoolExecutor(max_workers=4) as threads:
+            results = list(threads.map(
+                    lambda _: resizer.resize(img, (40, 30), (0, 0, 120, 80)),
+                    range(8)))
+    finally:
+        resizer.shutdown()
+    assert len(pools) == 1
+    for result in results:
+        extrema = ImageChops.difference(result, expected).getextrema()
+        assert max(high for _, high in extrema) <= 1
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import random
+from collections import Counter
+from datetime import datetime
+
+import pytest
+
+from walliser.store import WallpaperStore
+from walliser.wallpaper import Wallpaper
+from walliser.sampler import FenwickTree, WeightedSampler
+
+
+def make_wallpapers(count, **data):
+    store = WallpaperStore()
+    now = datetime.now()
+    return [Wallpaper(store, store.add("{:040x}".format(i),
+                                       paths=["/wallpapers/{}.jpg".format(i)],
+                                       format="JPEG", width=1920, height=1080,
+                                       added=now, modified=now, **data))
+            for i in range(count)]
+
+def by_rating(store, row, now):
+    return float(max(0, store.rating[row]))
+
+
+def linear_find(weights, value):
+    total = 0.0
+    for i, weight in enumerate(weights):
+        total += weight
+        if total > value:
+            return i
+    return len(weights) - 1
+
+@pytest.mark.parametrize("size", [1, 2, 7, 8, 9, 100])
+def test_fenwick_tree_find(size):
+    rng = random.Random(size)
+    weights = [rng.choice((0, 0.5, 1, 3)) for _ in range(size)]
+    tree = FenwickTree(weights)
+    assert tree.total == pytest.approx(sum(weights))
+    assert tree.nonzero == sum(1 for weight in weights if weight)
+    for _ in range(200):
+        value = rng.random() * tree.total
+        assert tree.find(value) == linear_find(weights, value)
+
+def test_fenwick_tree_updates():
+    rng = random.Random(0)
+    weights = [1.0] * 50
+    tree = FenwickTree(weights)
+    for _ in range(500):
+        i = rng.randrange(len(weights))
+        weights[i] = rng.choice((0.0, 0.25, 2.0))
+        tree[i] = weights[i]
+        assert tree[i] == weights[i]
+        assert tree.nonzero == sum(1 for weight in weights if weight)
+        value = rng.random() * tree.total
+        assert tree.find(value) == linear_find(weights, value)
+    assert tree.total == pytest.approx(sum(weights))
+
+
+def test_sampler_holds_back_recent():
+    wallpapers = make_wallpapers(20)
+    sampler = WeightedSampler(wallpapers, recent=5)
+    drawn = [next(sampler) for _ in range(500)]
+    for i in range(len(drawn) - 5):
+        assert len(set(drawn[i:i + 6])) == 6
+
+def test_sampler_holds_back_at_most_half():
+    wallpapers = make_wallpapers(4)
+    sampler = WeightedSampler(wallpapers, recent=50)
+    drawn = [next(sampler) for _ in range(100)]
+    assert set(drawn) == set(wallpapers)
+    for i in range(len(drawn) - 2):
+        assert len(set(drawn[i:i + 3])) == 3
+
+def test_sampler_follows_weights():
+    random.seed(0)
+    wallpapers = make_wallpapers(3)
+    for wp, rating in zip(wallpapers, (1, 2, 7)):
+        wp.rating = rating
+    sampler = WeightedSampler(wallpapers, weight=by_rating, recent=0)
+    counts = Counter(next(sampler) for _ in range(10000))
+    for wp, share in zip(wallpapers, (.1, .2, .7)):
+        assert counts[wp] / 10000 == pytest.approx(share, abs=.03)
+
+def test_sampler_updates_weights_of_changed_wallpapers():
+    wallpapers = make_wallpapers(10, rating=1)
+    store = wallpapers[0]._store
+    sampler = WeightedSampler(wallpapers, weight=by_rating, recent=3)
+    for wp in wallpapers[1:]:
+        wp.rating = 0
+    store.changes.publish()
+    # the only one left is drawn even while it's held back
+    assert [next(sampler) for _ in range(10)] == [wallpapers[0]] * 10
+    wallpapers[0].rating = 0
+    store.changes.publish()
+    with pytest.raises(StopIteration):
+        next(sampler)
+    wallpapers[5].rating = 3
+    store.changes.publish()
+    assert next(sampler) is wallpapers[5]
+    sampler.close()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from walliser.screen import (parse_xrandr, parse_screen_sizes, ScreenProbe,
+                             Cycler, Collection)
+
+# recorded `xrandr --query` output, shortened to the first mode per output
+XRANDR_OUTPUT = """\
+Screen 0: minimum 320 x 200, current 5760 x 1920, maximum 16384 x 16384
+eDP-1 connected primary 1920x1080+0+840 (normal left inverted right x axis y axis) 344mm x 194mm
+   1920x1080     60.02*+  59.93    48.00
+DP-1 connected 1080x1920+1920+0 left (normal left inverted right x axis y axis) 527mm x 296mm
+   1920x1080     60.00*+  74.97    50.00
+HDMI-1 connected 2560x1440+3000+480 (normal left inverted right x axis y axis) 597mm x 336mm
+   2560x1440     59.95*+
+DP-2 connected (normal left inverted right x axis y axis)
+   1920x1080     60.00 +
+VGA-1 disconnected (normal left inverted right x axis y axis)
+"""
+
+def test_parse_xrandr():
+    assert list(parse_xrandr(XRANDR_OUTPUT)) == [
+        dict(output="eDP-1", primary=True, width=1920, height=1080,
+             x=0, y=840),
+        # rotated, so it reports its size as it is laid out
+        dict(output="DP-1", primary=False, width=1080, height=1920,
+             x=1920, y=0),
+        dict(output="HDMI-1", primary=False, width=2560, height=1440,
+             x=3000, y=480),
+        # DP-2 is connected but inactive, VGA-1 disconnected
+    ]
+
+def test_parse_xrandr_without_screens():
+    assert list(parse_xrandr("")) == []
+
+
+def wait_for_changes(probe, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        changes = probe.take_changes()
+        if changes is not None:
+            return changes
+        time.sleep(.01)
+    return None
+
+def test_probe_reports_changes():
+    outputs = [XRANDR_OUTPUT]
+    queries = []
+    def query():
+        output = outputs[-1]
+        queries.append(output)
+        return output
+    probe = ScreenProbe(interval=.01, query=query)
+    try:
+        # the first probe is only the baseline, repeating it changes nothing
+        while len(queries) < 3:
+            time.sleep(.01)
+        assert probe.take_changes() is None
+        # HDMI-1 unplugged
+        outputs.append("\n".join(line for line in XRANDR_OUTPUT.splitlines()
+                                 if not line.startswith("HDMI-1")))
+        changes = wait_for_changes(probe)
+        assert [data["output"] for data in changes] == ["eDP-1", "DP-1"]
+        assert probe.take_changes() is None
+    finally:
+        probe.close()
+
+def test_probe_ignores_failing_queries():
+    def query():
+        raise OSError("xrandr not found")
+    probe = ScreenProbe(interval=.01, query=query)
+    try:
+        assert wait_for_changes(probe, timeout=.1) is None
+    finally:
+        probe.close()
+
+def test_probe_with_other_parser():
+    outputs = ["1920x1080"]
+    queries = []
+    def query():
+        output = outputs[-1]
+        queries.append(output)
+        return output
+    probe = ScreenProbe(interval=.01, query=query, parser=parse_screen_sizes)
+    try:
+        while not queries:
+            time.sleep(.01)
+        outputs.append("1920x1080,1280x1024")
+        changes = wait_for_changes(probe)
+        assert [(data["width"], data["x"]) for data in changes] == [
+            (1920, 0), (1280, 1920)]
+    finally:
+        probe.close()
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.steps = 0
+
+    def next(self):
+        self.steps += 1
+
+class FakeScreenController:
+
+    def __init__(self, outputs):
+        self.screens = [SimpleNamespace(output=output, paused=False,
+                                        wallpapers=FakeCollection())
+                        for output in outputs]
+        self.render_cache = SimpleNamespace(render_time=.1)
+        self.prefetched = 0
+
+    def advance(self, screens):
+        for screen in screens:
+            screen.wallpapers.next()
+        return bool(screens)
+
+    def prefetch(self):
+        self.prefetched += 1
+
+def steps(scrctrl):
+    return [screen.wallpapers.steps for screen in scrctrl.screens]
+
+def test_cycler_restart_and_hold():
+    now = [0]
+    scrctrl = FakeScreenController(["A", "B"])
+    cycler = Cycler(scrctrl, 5, clock=lambda: now[0])
+    a, b = scrctrl.screens
+    now[0] = 3
+    cycler.restart(a)  # A changed by hand, next tick at 8
+    now[0] = 5
+    # B advances, A next prefetches .3 s before its tick at 8
+    assert cycler.poll() == (True, pytest.approx(2.7))
+    assert steps(scrctrl) == [0, 1]
+    now[0] = 7.7
+    assert cycler.poll() == (False, pytest.approx(.3))
+    assert scrctrl.prefetched == 1
+    now[0] = 8
+    assert cycler.poll()[0]
+    assert steps(scrctrl) == [1, 1]
+    now[0] = 10
+    # B is being edited, it misses its tick
+    assert cycler.poll(held=[b]) == (False, pytest.approx(2.7))
+    assert steps(scrctrl) == [1, 1]
+    now[0] = 15
+    cycler.poll()
+    assert steps(scrctrl) == [2, 2]
+
+def test_cycler_skips_missed_ticks():
+    now = [0]
+    scrctrl = FakeScreenController(["A"])
+    cycler = Cycler(scrctrl, 5, clock=lambda: now[0])
+    now[0] = 23  # suspended
+    assert cycler.poll() == (True, pytest.approx(1.7))
+    assert steps(scrctrl) == [1]
+
+def test_cycler_starts_new_screens_when_seen():
+    now = [0]
+    scrctrl = FakeScreenController(["A"])
+    cycler = Cycler(scrctrl, 5, clock=lambda: now[0])
+    now[0] = 23
+    cycler.poll()
+    scrctrl.screens.append(FakeScreenController(["B"]).screens[0])
+    now[0] = 24
+    cycler.poll()
+    assert steps(scrctrl) == [1, 0]
+    now[0] = 29
+    cycler.poll()
+    assert steps(scrctrl) == [2, 1]
+
+
+def test_collection_upcoming_is_not_history():
+    collection = Collection(iter(range(10)))
+    assert collection.current == 0
+    assert collection.upcoming(3) == [1, 2, 3]
+    assert len(collection) == 1
+    # back from the first wallpaper stays with what was shown
+    collection.prev()
+    assert collection.current == 0
+    collection.next()
+    assert collection.current == 1
+    collection.next()
+    collection.prev()
+    collection.prev()
+    assert collection.current == 0
+    assert collection.upcoming(3) == [1, 2, 3]
+    for expected in (1, 2, 3):
+        collection.next()
+        assert collection.current == expected
+    assert collection.upcoming(2) == [4, 5]
+
+def test_collection_cycles_when_source_runs_out():
+    collection = Collection(iter("abc"))
+    assert collection.current == "a"
+    assert collection.upcoming(5) == ["b", "c", "a"]
+    shown = []
+    for _ in range(5):
+        shown.append(collection.current)
+        collection.next()
+    assert shown == ["a", "b", "c", "a", "b"]
@@ -3,30 +3,75 @@
 """Walliser - A tool for cycling through wallpapers.
 
 Usage:
-  walliser [-q QUERY] [-s KEY [--reverse]] [-i SECONDS]
-           [-c CONFIG_FILE] [--readonly]
+  walliser [-q QUERY] [-s KEY [--reverse]] [--limit N] [-i SECONDS]
+           [--span] [-c CONFIG_FILE] [--readonly]
+           [--cache-size MB] [--memory-cache MB] [--resize-workers N]
+           [--setter NAME] [--screens RESOLUTIONS] [--thumbnail-cache MB]
+           [--prerender RESOLUTIONS] [--variant-cache MB]
            [--quiet | -v | -vv | -vvv]
            [--] [FILES/DIRS ...]
   walliser (--list | --list-tags) [-c CONFIG_FILE]
-           [-q QUERY] [-s KEY [--reverse]] [--] [FILES/DIRS ...]
-  walliser --maintenance [-c CONFIG_FILE] [--readonly] [--quiet | -v | -vv | -vvv]
+           [-q QUERY] [-s KEY [--reverse]] [--limit N] [--] [FILES/DIRS ...]
+  walliser (--maintenance | --verify) [-c CONFIG_FILE] [--readonly]
+           [--dry-run] [--quiet | -v | -vv | -vvv]
+  walliser --duplicates [-c CONFIG_FILE] [--readonly] [-q QUERY]
+           [--quiet | -v | -vv | -vvv]
+  walliser --thumbnails [-c CONFIG_FILE] [--thumbnail-cache MB]
+           [-q QUERY] [-s KEY [--reverse]] [--limit N]
+           [--quiet | -v | -vv | -vvv]
   walliser -h | --help | --version
 
 Options:
   -q QUERY --query QUERY
                  Filter wallpapers using Python expressions.
+                 Besides stored attributes and tags, features of the
+                 image content can be queried with the prefix `image.`:
+                 luminance and the shares of red, yellow, green, cyan,
+                 blue, magenta and grey range from 0 to 1, e.g.
+                 `image.lum < .3` or `image.blue > .5`.
                  [default: rating >= 0]
   -i SECONDS --interval SECONDS
-                 Seconds between updates (may be float) [default: 5]
+                 Seconds between updates (may be float), 0 disables
+                 automatic cycling [default: 5]
   -s KEY --sort KEY
                  Cycle through wallpapers in order sorted by attribute KEY
          --reverse
                  Sort backwards
+     --limit N   Only use the first N wallpapers (after sorting). Without
+                 --sort picks N random wallpapers.
+     --span      Stretch each wallpaper across all screens.
   -c CONFIG_FILE --config-file CONFIG_FILE
                  Read and store wallpaper data in this file. If not specified
                  will use WALLISER_DATABASE_FILE from environment variable or
                  default to ~/.walliser.json.gz instead.
      --readonly  Don't write anything to the configuration file.
+     --cache-size MB
+                 Disk space used for caching transformed wallpapers
+                 [default: 512]
+     --memory-cache MB
+                 Memory used for keeping decoded wallpapers around, which
+                 makes adjusting zoom and offsets faster [default: 256]
+     --prerender RESOLUTIONS
+                 Render wallpapers without transformations in the background
+                 for screens of these sizes, e.g. 1920x1080,2560x1440, so
+                 large originals don't need to be scaled down every time.
+     --variant-cache MB
+                 Disk space used for pre-rendered wallpapers. Only the best
+                 rated wallpapers that fit are pre-rendered [default: 2048]
+     --resize-workers N
+                 Resize very large images on N processes in parallel.
+                 0 or 1 resizes everything in a single pass [default: 0]
+     --thumbnail-cache MB
+                 Disk space used for thumbnails, which are previewed by
+                 pressing v [default: 128]
+     --setter NAME
+                 How wallpapers are put on screen: feh, xlib (draws directly
+                 without starting a process, requires python-xlib) or none
+                 [default: feh]
+     --screens RESOLUTIONS
+                 Use screens of these sizes side by side, e.g.
+                 1920x1080,2560x1440, instead of asking xrandr. Together
+                 with --setter none this runs without X.
   -l --list      List all wallpaper paths which match a given query
   -t --list-tags
                  Show a list of all tags with number of wallpapers and exit.
@@ -34,6 +79,21 @@ Options:
      --remove-tag
                  Remove given tag from all wallpapers (respects --query)
      --maintenance
+                 Invalidate paths of files that no longer exist and delete
+                 unrated entries without any valid paths left.
+     --verify    Find files whose content changed since they were added,
+                 by hashing those whose size or modification time differ.
+                 Their paths are moved to records matching the new content.
+     --dry-run   Only report what maintenance or verification would change.
+     --duplicates
+                 List groups of wallpapers that look almost the same, like
+                 copies at different resolutions. (respects --query)
+                 In queries `image.duplicates` are the other wallpapers
+                 that look almost the same as a wallpaper.
+     --thumbnails
+                 Create missing thumbnails of wallpapers matching the query
+                 and print their paths, e.g. for contact sheets with
+                 `feh --index`.
   -v --verbose   Show more and more info.
      --quiet     Don't write any output after exiting fullscreen.
   -h --help      Show this help message and exit.
@@ -49,8 +109,15 @@ from docopt import docopt
 from . import __version__
 from .util import BufferedLogHandler, FancyLogFormatter
 from .config import Config
-from .wallpaper import WallpaperController
-from .screen import ScreenController
+from .wallpaper import (WallpaperController, find_invalid_paths,
+                        invalidate_paths, find_modified_paths, hash_files)
+from .screen import ScreenController, ScreenProbe, parse_screen_sizes
+from .setters import SETTERS
+from .similarity import group_similar
+from .render import (RenderCache, ImageCache, Prerenderer,
+                     parse_resolutions, default_cache_dir)
+from .resample import TiledResizer
+from .thumbnails import ThumbnailCache
 from .urwid import Ui
 # from .core import Core
 
@@ -96,28 +163,102 @@ def main():
 
         if args["--maintenance"]:
             wpctrl = WallpaperController(config=config, query="True")
-            delete_hashes = set()
-            for wp in wpctrl.wallpapers:
-                if not wp.check_paths() and wp.rating <= 0:
-                    delete_hashes.add(wp.hash)
+            invalid = find_invalid_paths(wpctrl.wallpapers, workers=16,
+                                         show_progress=True)
+            invalid_counts = Counter(wp for wp, _ in invalid)
+            dead = [wp for wp, count in invalid_counts.items()
+                    if count == len(wp.paths)]
+            delete = [wp for wp in dead if wp.rating <= 0]
+            log.info("Found %d invalid paths and %d entries without valid"
+                     " paths, %d of them unrated.",
+                     len(invalid), len(dead), len(delete))
+            if args["--dry-run"]:
+                config.readonly = True
+                for _, path in invalid:
+                    print("invalid", path)
+                for wp in delete:
+                    print("delete", wp.hash, wp.path)
+                return 0
+            log.info("Deleting %d dead entries.", len(delete))
+            invalidate_paths(invalid)
+            wpctrl.delete(delete)
             wpctrl.save_updates()
-            log.info("Deleting {} dead entries.".format(len(delete_hashes)))
-            for hash in delete_hashes:
-                del config._data["wallpapers"][hash]
             return 0
 
+        if args["--verify"]:
+            wpctrl = WallpaperController(config=config, query="True")
+            files = find_modified_paths(wpctrl.wallpapers, workers=16,
+                                        show_progress=True)
+            suspicious = [(wp, path, size) for wp, path, size, suspicious
+                          in files if suspicious]
+            log.info("Hashing %d of %d files that may have changed.",
+                     len(suspicious), len(files))
+            hashes = hash_files([path for _, path, _ in suspicious],
+                                workers=16, show_progress=True)
+            changed = [(wp, path, size, hash)
+                       for (wp, path, size), hash in zip(suspicious, hashes)
+                       if hash and hash != wp.hash]
+            log.info("Found %d changed files.", len(changed))
+            if args["--dry-run"]:
+                config.readonly = True
+                for wp, path, _, hash in changed:
+                    print("changed", path, wp.hash, "->", hash)
+                return 0
+            # remember signatures that were confirmed or didn't exist yet
+            changed_paths = {path for _, path, _, _ in changed}
+            for wp, path, size, suspicious in files:
+                if ((suspicious or not wpctrl.store.file_size[wp._row])
+                        and path not in changed_paths):
+                    wpctrl.sign(wp, size)
+            for wp, path, size, hash in changed:
+                wpctrl.move_path(wp, path, hash, size)
+            wpctrl.save_updates()
+            return 0
 
+        if args["--duplicates"]:
+            wpctrl = WallpaperController(config=config, query=args["--query"])
+            wpctrl.add_features(wpctrl.wallpapers, show_progress=True)
+            groups = group_similar({wp: wp.phash for wp in wpctrl.wallpapers
+                                    if wp.phash})
+            log.info("Found %d groups of near-duplicates.", len(groups))
+            for group in groups:
+                group.sort(key=lambda wp: wp.width * wp.height, reverse=True)
+                print()
+                for wp in group:
+                    print(f"{wp.width:>5}x{wp.height:<5} {wp.rating:>2} "
+                          f"{wp.path}")
+            wpctrl.save_updates()
+            return 0
+
+
+        limit = None
+        if args["--limit"]:
+            try:
+                limit = int(args["--limit"])
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                raise Exception("Invalid limit '{}', use a number of at least 1."
+                                .format(args["--limit"]))
+        if args["--list"] or args["--thumbnails"] or args["--list-tags"]:
+            config.readonly = True
         wpctrl = WallpaperController(config=config,
                                      sources=args["FILES/DIRS"],
                                      query=args["--query"],
                                      sort=args["--sort"],
-                                     reverse=args["--reverse"])
+                                     reverse=args["--reverse"],
+                                     limit=limit)
         if args["--list"]:
-            config.readonly = True
             for wp in wpctrl.wallpapers:
                 print(wp.path)
+        elif args["--thumbnails"]:
+            thumbnail_cache = ThumbnailCache(
+                    max_bytes=int(float(args["--thumbnail-cache"]) * 2**20))
+            paths = thumbnail_cache.get(wpctrl.wallpapers, show_progress=True)
+            thumbnail_cache.shutdown()
+            for path in filter(None, paths):
+                print(path)
         elif args["--list-tags"]:
-            config.readonly = True
             tag_counts = Counter()
             for wp in wpctrl.wallpapers:
                 tag_counts.update(wp.tags)
@@ -127,10 +268,53 @@ def main():
         else:
             # run the actual application
             logging_handler.auto_flush = False
-            scrctrl = ScreenController(wpctrl)
+            image_cache = ImageCache(
+                          max_bytes=int(float(args["--memory-cache"]) * 2**20))
+            resizer = TiledResizer(int(args["--resize-workers"]))
+            render_cache = RenderCache(
+                            max_bytes=int(float(args["--cache-size"]) * 2**20),
+                            image_cache=image_cache,
+                            resizer=resizer)
+            variants = RenderCache(
+                        directory=default_cache_dir("variants"),
+                        max_bytes=int(float(args["--variant-cache"]) * 2**20),
+                        resizer=resizer,
+                        extension="jpg")
+            if args["--setter"] not in SETTERS:
+                raise Exception("Unknown setter '{}', choose one of {}."
+                                .format(args["--setter"], ", ".join(SETTERS)))
+            screens_data = probe = None
+            if args["--screens"]:
+                screens = args["--screens"]
+                screens_data = list(parse_screen_sizes(screens))
+                # never changes
+                probe = ScreenProbe(query=lambda: screens,
+                                    parser=parse_screen_sizes)
+            scrctrl = ScreenController(wpctrl, render_cache,
+                                       span=args["--span"],
+                                       setter=SETTERS[args["--setter"]](),
+                                       variants=variants,
+                                       screens_data=screens_data,
+                                       probe=probe)
             scrctrl.display_wallpapers()
-            Ui(scrctrl, wpctrl).run_loop()
+            prerenderer = None
+            if args["--prerender"]:
+                prerenderer = Prerenderer(variants,
+                                          parse_resolutions(args["--prerender"]))
+                prerenderer.submit(wpctrl.wallpapers)
+            thumbnail_cache = ThumbnailCache(
+                    max_bytes=int(float(args["--thumbnail-cache"]) * 2**20))
+            Ui(scrctrl, wpctrl,
+               interval=float(args["--interval"]),
+               thumbnail_cache=thumbnail_cache).run_loop()
+            scrctrl.shutdown()
+            if prerenderer:
+                prerenderer.shutdown()
+            thumbnail_cache.shutdown()
+            resizer.shutdown()
             wpctrl.save_updates()
+            log.debug("Render cache: %s", render_cache)
+            log.debug("Variants: %s", variants)
         return 0
     except (KeyboardInterrupt, SystemExit):
         return 0
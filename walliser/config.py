@@ -5,18 +5,21 @@ import shutil
 import gzip
 import json
 import logging
+from collections.abc import Mapping
 from datetime import datetime
 
 log = logging.getLogger(__name__)
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-TIME_KEYS = {"added", "modified"}
+TIME_KEYS = {"added", "modified", "verified"}
+
+PATH_KEYS = {"paths", "invalid_paths"}
 
 def dict_update_recursive(a, b):
     """Recursiveley merge dictionaries. Mutates first argument."""
     for key in b:
-        if key in a and isinstance(a[key], dict) and isinstance(b[key], dict):
+        if key in a and isinstance(a[key], dict) and isinstance(b[key], Mapping):
             dict_update_recursive(a[key], b[key])
         else:
             a[key] = b[key]
@@ -30,14 +33,40 @@ def _open_config_file(filename, mode="r"):
 
 def _serialize(obj):
     """Serialize things we know how to serialize."""
+    if isinstance(obj, Mapping):
+        return dict(obj)
     return obj.strftime(TIME_FORMAT)
 
+def _encode_paths(data):
+    """Store wallpaper paths as [directory id, file name] against a shared
+    table of directories instead of repeating the same directories."""
+    directories = {}
+    def encode(path):
+        directory, name = os.path.split(path)
+        return [directories.setdefault(directory, len(directories)), name]
+    wallpapers = {}
+    for hash, wp_data in data.get("wallpapers", {}).items():
+        wp_data = dict(wp_data)
+        for key in PATH_KEYS & wp_data.keys():
+            wp_data[key] = list(map(encode, wp_data[key]))
+        wallpapers[hash] = wp_data
+    return {**data, "directories": list(directories), "wallpapers": wallpapers}
+
+def _decode_paths(data):
+    """Inverse of _encode_paths. Mutates argument."""
+    directories = data.pop("directories", None)
+    if directories is None:  # old format
+        return data
+    for wp_data in data.get("wallpapers", {}).values():
+        for key in PATH_KEYS & wp_data.keys():
+            wp_data[key] = [os.path.join(directories[directory_id], name)
+                            for directory_id, name in wp_data[key]]
+    return data
+
 def _deserialize(obj):
     for key in TIME_KEYS:
-        try:
+        if obj.get(key) is not None:
             obj[key] = datetime.strptime(obj[key], TIME_FORMAT)
-        except KeyError:
-            pass
     return obj
 
 
@@ -62,7 +91,8 @@ class Config:
     def _load_data(self):
         try:
             with _open_config_file(self._filename, "rt") as config_file:
-                return json.load(config_file, object_hook=_deserialize)
+                return _decode_paths(json.load(config_file,
+                                               object_hook=_deserialize))
         except FileNotFoundError:
             log.info("No config found at '%s'", self._filename)
         except ValueError: # bad json
@@ -74,18 +104,41 @@ class Config:
     def __getitem__(self, key):
         return self._data[key]
 
+    def __setitem__(self, key, value):
+        """Values may be any Mapping, not just dicts."""
+        self._data[key] = value
+
     def rec_update(self, data):
         """update recursively (only dicts, no other collection types)"""
         dict_update_recursive(self._data, data)
 
-    def save(self):
-        """Save current configuration into given file."""
+    def save(self, updates=None, deletes=None, partial=None):
+        """Save current configuration into given file.
+        If the file was modified since loading only `updates` (if given)
+        are merged into the file's content and `deletes`, mapping keys to
+        collections of sub keys, are removed from it.
+        `partial`, mapping keys to collections of sub keys, marks updates
+        that only complete existing entries. They are dropped if the entry
+        is gone from the file, e.g. because it was deleted meanwhile."""
         if self.readonly:
             return
         data = self._load_data()
         if data["modified"] > self._data["modified"]:
             log.info("Config has been outdated since startup.")
-            dict_update_recursive(data, self._data)
+            if updates is None:
+                updates = self._data
+            else:
+                updates = dict(updates)
+                for key, sub_keys in (partial or {}).items():
+                    existing = data.get(key, {})
+                    updates[key] = {sub_key: value
+                                    for sub_key, value in updates[key].items()
+                                    if sub_key in existing
+                                    or sub_key not in sub_keys}
+            dict_update_recursive(data, updates)
+            for key, sub_keys in (deletes or {}).items():
+                for sub_key in sub_keys:
+                    data.get(key, {}).pop(sub_key, None)
         else:
             data = self._data
         data["modified"] = self._data["modified"] = datetime.now()
@@ -97,4 +150,5 @@ class Config:
             shutil.copyfile(self._filename, backup)
 
         with _open_config_file(self._filename, "wt") as config_file:
-            json.dump(data, config_file, default=_serialize, separators=(",", ":"))
+            json.dump(_encode_paths(data), config_file,
+                      default=_serialize, separators=(",", ":"))
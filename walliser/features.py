@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Features of wallpapers' content, computed once when they are added so
+queries never have to look at the images themselves."""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops, ImageStat
+
+from .similarity import dhash_images
+from .progress import progress
+
+# images are analysed at this size, plenty for hashes and colour statistics
+ANALYSIS_SIZE = 64
+
+# Colour histogram bins: hues centred on multiples of 60°, and grey for
+# pixels too dull or too dark to have a meaningful hue.
+HUES = ("red", "yellow", "green", "cyan", "blue", "magenta")
+COLOR_BINS = HUES + ("grey",)
+MIN_SATURATION = 64
+MIN_VALUE = 48
+
+DOMINANT_COLORS = 3
+
+# packed colour features: mean luminance, histogram (shares of 255) and
+# dominant colours (RGB), all zero if unknown
+HISTOGRAM_OFFSET = 1
+DOMINANT_OFFSET = HISTOGRAM_OFFSET + len(COLOR_BINS)
+COLOR_BYTES = DOMINANT_OFFSET + 3 * DOMINANT_COLORS
+
+
+def color_features(img):
+    """Packed colour features of a small RGB image."""
+    pixels = img.width * img.height
+    luminance = round(ImageStat.Stat(img.convert("L")).mean[0])
+    hue, saturation, value = img.convert("HSV").split()
+    chromatic = ImageChops.multiply(
+                saturation.point(lambda v: 255 if v >= MIN_SATURATION else 0),
+                value.point(lambda v: 255 if v >= MIN_VALUE else 0))
+    counts = [0] * len(HUES)
+    for h, count in enumerate(hue.histogram(mask=chromatic)):
+        # hue is scaled to 0-255, shift by half a bin so red is centred on 0
+        counts[(h * 2 * len(HUES) + 256) // 512 % len(HUES)] += count
+    counts.append(pixels - sum(counts))
+    histogram = [round(255 * count / pixels) for count in counts]
+    quantized = img.quantize(DOMINANT_COLORS, method=Image.MEDIANCUT)
+    palette = quantized.getpalette()
+    dominant = []
+    for _, index in sorted(quantized.getcolors(), reverse=True):
+        dominant += palette[3 * index:3 * index + 3]
+    # images with fewer colours repeat the last one
+    dominant += dominant[-3:] * (DOMINANT_COLORS - len(dominant) // 3)
+    return bytes([luminance] + histogram + dominant)
+
+def analyze_batch(paths):
+    """Worker: [(perceptual hash, colour features), ...] of a batch of image
+    files, (0, None) for those that can't be read. Every image is decoded
+    only once, at reduced size if the format allows."""
+    images = []
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                img.draft("RGB", (ANALYSIS_SIZE, ANALYSIS_SIZE))
+                images.append(img.convert("RGB").resize(
+                                (ANALYSIS_SIZE, ANALYSIS_SIZE),
+                                resample=Image.BOX))
+        except (OSError, ValueError, Image.DecompressionBombError):
+            images.append(None)
+    colors = [img and color_features(img) for img in images]
+    return list(zip(dhash_images(images), colors))
+
+def analyze_files(paths, workers=None, batch_size=64, show_progress=False):
+    """Like analyze_batch for any number of files, computed in batches on a
+    process pool."""
+    paths = list(paths)
+    if not paths:
+        return []
+    batches = [paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size)]
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = executor.map(analyze_batch, batches)
+        if show_progress:
+            results = progress(results, total=len(batches),
+                               text="analyzing images")
+        return [features for batch in results for features in batch]
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import hashlib
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from operator import attrgetter
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dir(name):
+    """Directory inside the user's cache directory (XDG)."""
+    cache_home = (os.environ.get("XDG_CACHE_HOME")
+                  or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "walliser", name)
+
+
+@dataclass(frozen=True)
+class RenderRequest:
+    """Everything that determines how a wallpaper is rendered on a screen.
+    This is a snapshot, so the wallpaper may change while rendering."""
+
+    hash: str
+    path: str
+    format: str
+    source_width: int
+    source_height: int
+    x_offset: int
+    y_offset: int
+    zoom: float
+    transformations: tuple
+    width: int
+    height: int
+    # (width, height, x, y) when this is only the part at x, y of a larger
+    # canvas the wallpaper is spread across, e.g. spanning multiple screens
+    canvas: tuple = None
+
+    @classmethod
+    def of(cls, wallpaper, width, height, canvas=None):
+        return cls(hash=wallpaper.hash,
+                   path=wallpaper.path,
+                   format=wallpaper.format,
+                   source_width=wallpaper._width,
+                   source_height=wallpaper._height,
+                   x_offset=wallpaper.x_offset,
+                   y_offset=wallpaper.y_offset,
+                   zoom=wallpaper.zoom,
+                   transformations=wallpaper.transformations,
+                   width=width,
+                   height=height,
+                   canvas=canvas)
+
+    @property
+    def key(self):
+        """Identifies the result, independent of where the source lives."""
+        key = (self.hash, self.x_offset, self.y_offset, self.zoom,
+               self.transformations, self.width, self.height)
+        if self.canvas is not None:
+            key += (self.canvas,)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @property
+    def canvas_size(self):
+        if self.canvas is None:
+            return self.width, self.height
+        return self.canvas[:2]
+
+    @property
+    def extension(self):
+        return 'jpg' if self.format == 'JPEG' else 'ppm'
+
+
+# Renders are read back by the setter right away, so encoding speed matters
+# more than file size. At 3840x2160 PNG takes ~2 s to encode, PPM ~12 ms.
+# extension -> (PIL format, save options)
+ENCODERS = {
+    'jpg': ('JPEG', {'quality': 95}),
+    'ppm': ('PPM', {}),
+}
+
+_rotations = {90: Image.ROTATE_90,
+              180: Image.ROTATE_180,
+              270: Image.ROTATE_270}
+
+def _reduction(request):
+    """Largest JPEG draft reduction (1, 2, 4 or 8) that still decodes
+    at least the resolution needed on screen."""
+    if request.format != 'JPEG':
+        return 1
+    width, height = request.source_width, request.source_height
+    if request.transformations[2] % 180:
+        width, height = height, width
+    canvas_width, canvas_height = request.canvas_size
+    scale = request.zoom * max(canvas_width / width, canvas_height / height)
+    reduction = 1
+    while reduction < 8 and scale * reduction * 2 <= 1:
+        reduction *= 2
+    return reduction
+
+def _oriented(request, reduction=1):
+    """Decoded source image with flips and rotation applied.
+    JPEGs are decoded at 1/reduction of their size."""
+    with Image.open(request.path) as img:
+        if reduction > 1:
+            img.draft(img.mode, (img.width // reduction,
+                                 img.height // reduction))
+        img.load()
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "transparency" in img.info
+                                     or "A" in img.getbands() else "RGB")
+        horizontal, vertical, rotate = request.transformations
+        if horizontal:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        if vertical:
+            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        if rotate:
+            img = img.transpose(_rotations[rotate])
+        return img
+
+def _resized(img, size, box, resizer=None):
+    if resizer is not None and resizer.applies(img, size, box):
+        return resizer.resize(img, size, box)
+    return img.resize(size, resample=Image.LANCZOS, box=box,
+                      reducing_gap=3.0)
+
+def _crop_resized(img, request, resizer=None):
+    """Scale img to fill the screen (times zoom) and crop it. Only the
+    region that actually ends up on screen is resized.
+    Very large regions may be split up by a TiledResizer."""
+    width, height = request.width, request.height
+    canvas_width, canvas_height, x, y = request.canvas or (width, height, 0, 0)
+    scale = request.zoom * max(canvas_width / img.width,
+                               canvas_height / img.height)
+    # visible region in source coordinates
+    left = ((img.width - canvas_width / scale) / 2
+            + (request.x_offset + x) / scale)
+    top = ((img.height - canvas_height / scale) / 2
+           + (request.y_offset + y) / scale)
+    box = (left, top, left + width / scale, top + height / scale)
+    if (box[0] >= 0 and box[1] >= 0
+            and box[2] <= img.width and box[3] <= img.height):
+        return _resized(img, (width, height), box, resizer)
+    # partially outside of the image, the rest stays black
+    canvas = Image.new(img.mode, (width, height))
+    visible = (max(box[0], 0), max(box[1], 0),
+               min(box[2], img.width), min(box[3], img.height))
+    size = (round((visible[2] - visible[0]) * scale),
+            round((visible[3] - visible[1]) * scale))
+    if size[0] > 0 and size[1] > 0:
+        canvas.paste(_resized(img, size, visible, resizer),
+                     (round((visible[0] - left) * scale),
+                      round((visible[1] - top) * scale)))
+    return canvas
+
+def render(request, images=None, resizer=None):
+    """Apply a wallpaper's transformations and crop it to screen size.
+    With an ImageCache the decoded source is kept, so successive pan and
+    zoom steps only redo the final resize and crop."""
+    reduction = _reduction(request)
+    if images is None:
+        img = _oriented(request, reduction)
+    else:
+        img = images.get((request.hash, request.transformations, reduction),
+                         lambda: _oriented(request, reduction))
+    return _crop_resized(img, request, resizer)
+
+
+class ImageCache:
+    """In-memory LRU of decoded images, bounded by their approximate size
+    in bytes. Meant to hold the wallpapers currently on screen."""
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()  # key -> image, least recent first
+        self._size = 0
+        self._pending = {}  # key -> Future of image
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        """Cached image for key, create()ing it if necessary.
+        Concurrent calls for the same key wait for a single create()."""
+        with self._lock:
+            try:
+                self._images.move_to_end(key)
+                return self._images[key]
+            except KeyError:
+                pass
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                create_here = True
+            else:
+                create_here = False
+        if not create_here:
+            return future.result()
+        try:
+            img = create()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._pending[key]
+            self._images[key] = img
+            self._size += _image_size(img)
+            self._evict()
+        future.set_result(img)
+        return img
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._images) > 1:
+            _, img = self._images.popitem(last=False)
+            self._size -= _image_size(img)
+
+def _image_size(img):
+    return img.width * img.height * len(img.getbands())
+
+def _flattened(img):
+    """RGB image of img on black, like it looks on an empty screen."""
+    img = img.convert("RGBA")
+    flat = Image.new("RGB", img.size)
+    flat.paste(img, mask=img)
+    return flat
+
+
+class RenderCache:
+    """Rendered wallpapers stored on disk, keyed by wallpaper,
+    transformations and screen resolution. When the total size exceeds
+    max_bytes the least recently used renders are evicted.
+    Thread safe, renders may be submitted to an executor in advance.
+    All renders are stored in one format if an extension is given.
+    """
+
+    def __init__(self, directory=None, max_bytes=512 * 2**20,
+                 image_cache=None, resizer=None, extension=None):
+        self.directory = directory or default_cache_dir("renders")
+        self.max_bytes = max_bytes
+        self.image_cache = image_cache
+        self.resizer = resizer
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.encode_times = {}  # extension -> (count, total seconds)
+        self.render_time = 0.0  # typical seconds per render
+        self._entries = OrderedDict()  # file name -> size, least recent first
+        self._size = 0
+        self._pending = {}  # file name -> Future of path
+        self._waiting = {}  # file name -> number of submits of pending render
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def __str__(self):
+        encode_times = ", ".join(
+            "{} encodes {:.1f} ms".format(extension, 1000 * total / count)
+            for extension, (count, total) in self.encode_times.items())
+        return ("{} renders, {:.1f} MiB, {} hits, {} misses{}"
+                .format(len(self._entries), self._size / 2**20,
+                        self.hits, self.misses,
+                        encode_times and ", " + encode_times))
+
+    def _scan(self):
+        """Pick up renders from previous sessions, ordered by last use."""
+        entries = []
+        with os.scandir(self.directory) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.startswith("."):  # unfinished write
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def _lookup(self, name):
+        """Path of a cached render or None. Call with lock held."""
+        if name not in self._entries:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)  # remember usage across sessions
+        except FileNotFoundError:
+            self._size -= self._entries.pop(name)
+            return None
+        self._entries.move_to_end(name)
+        return path
+
+    def _name(self, request):
+        return request.key + "." + (self.extension or request.extension)
+
+    def lookup(self, request, count=False):
+        """Path of the rendered wallpaper if it is cached, otherwise None.
+        Only counts hits if asked to, misses are counted when submitted."""
+        with self._lock:
+            path = self._lookup(self._name(request))
+            if count and path:
+                self.hits += 1
+            return path
+
+    def submit(self, request, executor, count=False):
+        """Future of the rendered wallpaper's path. Renders on executor
+        unless cached or already pending. Only counts hits and misses if
+        asked to, so prefetching doesn't distort them."""
+        name = self._name(request)
+        with self._lock:
+            path = self._lookup(name)
+            if count:
+                if path:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if path:
+                future = Future()
+                future.set_result(path)
+                return future
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+            if name in self._pending:
+                return self._pending[name]
+            future = self._pending[name] = Future()
+        def run():
+            if future.set_running_or_notify_cancel():
+                self._render(request, name, future)
+            else:
+                with self._lock:
+                    if self._pending.get(name) is future:
+                        del self._pending[name]
+                        del self._waiting[name]
+        executor.submit(run)
+        return future
+
+    def cancel(self, request):
+        """Withdraw one submit of request. The render is cancelled if no
+        other submit waits for it and it hasn't started yet."""
+        name = self._name(request)
+        with self._lock:
+            waiting = self._waiting.get(name, 0) - 1
+            if waiting > 0:
+                self._waiting[name] = waiting
+                return False
+            future = self._pending.get(name)
+        return future is not None and future.cancel()
+
+    def _render(self, request, name, future):
+        path = os.path.join(self.directory, name)
+        log.debug("Rendering '%s'", path)
+        start = time.perf_counter()
+        try:
+            self._write(render(request, self.image_cache, self.resizer), path)
+        except BaseException as e:
+            log.warning("Rendering '%s' failed: %s", request.path, e)
+            with self._lock:
+                del self._pending[name]
+                del self._waiting[name]
+            future.set_exception(e)
+        else:
+            duration = time.perf_counter() - start
+            with self._lock:
+                del self._pending[name]
+                del self._waiting[name]
+                # moving average, recent renders matter most
+                self.render_time += (duration - self.render_time) / 4
+            future.set_result(path)
+
+    def _write(self, img, path):
+        """Write atomically, so no one ever sees half written files."""
+        name = os.path.basename(path)
+        extension = os.path.splitext(path)[1][1:]
+        format, options = ENCODERS[extension]
+        if img.mode not in ("RGB", "L"):
+            img = _flattened(img)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".",
+                                        suffix="." + extension)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                start = time.perf_counter()
+                img.save(f, format=format, **options)
+                duration = time.perf_counter() - start
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        size = os.path.getsize(path)
+        with self._lock:
+            count, total = self.encode_times.get(extension, (0, 0))
+            self.encode_times[extension] = count + 1, total + duration
+            self._size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def parse_resolutions(string):
+    """'1920x1080,2560x1440' -> [(1920, 1080), (2560, 1440)]"""
+    resolutions = []
+    for resolution in filter(None, map(str.strip, string.split(","))):
+        try:
+            width, height = map(int, resolution.split("x"))
+        except ValueError:
+            raise Exception("Invalid resolution '{}', use WIDTHxHEIGHT."
+                            .format(resolution)) from None
+        resolutions.append((width, height))
+    return resolutions
+
+
+class Prerenderer:
+    """Renders wallpapers without transformations for a fixed set of
+    screen resolutions in the background. Screens of those sizes can then
+    show the result instead of scaling down a large original every time.
+    Best rated wallpapers come first, and no more is rendered than fits
+    into the cache, or the first variants would just be evicted again.
+    """
+
+    # only worth it for wallpapers at least this much larger than the screen
+    min_reduction = 2
+
+    # rough size of a JPEG variant in bytes per pixel
+    bytes_per_pixel = 3 / 10
+
+    def __init__(self, cache, resolutions, workers=1):
+        self.cache = cache
+        self.resolutions = resolutions
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="prerender")
+        self._closed = threading.Event()
+
+    def submit(self, wallpapers):
+        """Queue missing variants of wallpapers on a background thread, so
+        this returns right away."""
+        wallpapers = list(wallpapers)
+        threading.Thread(target=self._queue, args=(wallpapers,),
+                         name="prerender-queue", daemon=True).start()
+
+    def _queue(self, wallpapers):
+        budget = self.cache.max_bytes
+        count = 0
+        for wp in sorted(wallpapers, key=attrgetter("rating"), reverse=True):
+            if self._closed.is_set():
+                return
+            if wp.has_transformations:
+                continue
+            for width, height in self.resolutions:
+                if (max(width / wp.width, height / wp.height)
+                        > 1 / self.min_reduction):
+                    continue
+                budget -= width * height * self.bytes_per_pixel
+                if budget < 0:
+                    log.debug("Pre-rendering %d variants, the rest doesn't "
+                              "fit into the cache.", count)
+                    return
+                request = RenderRequest.of(wp, width, height)
+                if self.cache.lookup(request) is None:
+                    self.cache.submit(request, self._executor)
+                    count += 1
+        log.debug("Pre-rendering %d variants.", count)
+
+    def shutdown(self):
+        self._closed.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Resize very large images on multiple cores, strip by strip."""
+
+import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+from PIL import Image
+
+# radius of the LANCZOS kernel in output pixels
+LANCZOS_SUPPORT = 3
+
+# Beyond this downscaling factor a single pass resize with reducing_gap
+# is cheaper than a full LANCZOS pass split across cores.
+MAX_SCALE = 6
+
+
+class TiledResizer:
+    """Splits a resize into horizontal strips of the output which are
+    computed in parallel on a process pool. Source and result are exchanged
+    through shared memory. Every strip sees enough overlapping source rows
+    for the filter, so the result matches a single pass resize.
+    With less than two workers nothing is split. Thread safe.
+    """
+
+    def __init__(self, workers, min_pixels=40 * 10**6):
+        self.workers = workers
+        self.min_pixels = min_pixels
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def applies(self, img, size, box):
+        """Is this resize large enough to be worth splitting?"""
+        left, top, right, bottom = box
+        return (self.workers > 1 and img.mode in ("RGB", "RGBA", "L")
+                and (right - left) * (bottom - top) >= self.min_pixels
+                and (bottom - top) / size[1] < MAX_SCALE)
+
+    def resize(self, img, size, box):
+        """Like img.resize(size, resample=Image.LANCZOS, box=box)"""
+        with self._lock:
+            if self._executor is None:
+                # no fork, we have threads
+                self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"))
+            executor = self._executor
+        width, height = size
+        bands = len(img.getbands())
+        strips = min(self.workers * 2, height)
+        bounds = [height * i // strips for i in range(strips + 1)]
+        src = SharedMemory(create=True, size=img.width * img.height * bands)
+        dst = SharedMemory(create=True, size=width * height * bands)
+        try:
+            src.buf[:src.size] = img.tobytes()
+            jobs = [(src.name, img.mode, img.size, dst.name, size, box, y0, y1)
+                    for y0, y1 in zip(bounds, bounds[1:])]
+            for _ in executor.map(_resize_strip, *zip(*jobs)):
+                pass
+            return Image.frombytes(img.mode, size, bytes(dst.buf[:dst.size]))
+        finally:
+            src.close()
+            src.unlink()
+            dst.close()
+            dst.unlink()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _resize_strip(src_name, mode, src_size, dst_name, size, box, y0, y1):
+    """Worker: resize the output rows y0 to y1 into shared memory."""
+    src = SharedMemory(name=src_name)
+    dst = SharedMemory(name=dst_name)
+    try:
+        src_width, src_height = src_size
+        width, height = size
+        left, top, right, bottom = box
+        bands = src.size // (src_width * src_height)
+        scale = (bottom - top) / height  # source rows per output row
+        strip_top = top + y0 * scale
+        strip_bottom = top + y1 * scale
+        # source rows the filter may touch for this strip
+        margin = math.ceil(LANCZOS_SUPPORT * max(scale, 1)) + 1
+        first = max(0, math.floor(strip_top) - margin)
+        last = min(src_height, math.ceil(strip_bottom) + margin)
+        row_bytes = src_width * bands
+        part = Image.frombytes(mode, (src_width, last - first),
+                               bytes(src.buf[first * row_bytes:
+                                             last * row_bytes]))
+        part = part.resize((width, y1 - y0), resample=Image.LANCZOS,
+                           box=(left, strip_top - first,
+                                right, strip_bottom - first))
+        row_bytes = width * bands
+        dst.buf[y0 * row_bytes:y1 * row_bytes] = part.tobytes()
+    finally:
+        src.close()
+        dst.close()
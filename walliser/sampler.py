@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Selecting wallpapers for screens."""
+
+import math
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from .store import field_mask
+
+# fields the default weight depends on
+WEIGHT_FIELDS = ("paths", "rating", "views", "added")
+
+
+def default_weight(store, row, now):
+    """Prefer well rated, rarely seen and recently added wallpapers."""
+    if not store.paths[row]:
+        return 0.0
+    rating = max(-8, min(store.rating[row], 8))
+    age_days = max(0.0, now - store.added[row]) / 86400
+    return (2.0 ** rating
+            / math.sqrt(1 + store.views[row])
+            * (1 + math.exp(-age_days / 30)))
+
+
+class FenwickTree:
+    """Array of non-negative weights with prefix sums.
+    Updates and search by cumulative weight both take O(log n)."""
+
+    def __init__(self, weights):
+        self._values = array('d', weights)
+        size = len(self._values)
+        self._tree = array('d', bytes(8 * (size + 1)))  # 1-based
+        for i, weight in enumerate(self._values, 1):
+            self._tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+        self._top_bit = 1 << (size.bit_length() - 1) if size else 0
+        self.nonzero = sum(1 for weight in self._values if weight > 0)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        return self._values[i]
+
+    def __setitem__(self, i, weight):
+        delta = weight - self._values[i]
+        self.nonzero += (weight > 0) - (self._values[i] > 0)
+        self._values[i] = weight
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    @property
+    def total(self):
+        total = 0.0
+        i = len(self._values)
+        while i:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """Index i so that the sum of weights before i is <= value and
+        including i is > value."""
+        position = 0
+        step = self._top_bit
+        while step:
+            if (position + step < len(self._tree)
+                    and self._tree[position + step] <= value):
+                position += step
+                value -= self._tree[position]
+            step >>= 1
+        return min(position, len(self._values) - 1)
+
+
+class WeightedSampler:
+    """Endless random stream of wallpapers, drawn with probability
+    proportional to their weight. Recently drawn wallpapers are held back
+    until a number of others have been shown, or no others are left.
+    Weights follow changes to the store's wallpapers as they are published.
+    Runs out (StopIteration) only if no wallpaper has any weight left.
+    """
+
+    def __init__(self, wallpapers, weight=default_weight, recent=50):
+        self._wallpapers = list(wallpapers)
+        self._store = self._wallpapers[0]._store
+        self._weight = weight
+        self._index = {wp._row: i for i, wp in enumerate(self._wallpapers)}
+        now = time.time()
+        self._weights = array('d', (weight(self._store, wp._row, now)
+                                    for wp in self._wallpapers))
+        self._tree = FenwickTree(self._weights)
+        self._recent = deque()
+        self._held_back = set()
+        self._max_recent = min(recent, len(self._wallpapers) // 2)
+        self._lock = threading.Lock()
+        self._store.changes.subscribe(self._update,
+                                      field_mask(WEIGHT_FIELDS))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            while True:
+                if not self._tree.nonzero and not self._release():
+                    raise StopIteration
+                i = self._tree.find(random.random() * self._tree.total)
+                if not self._tree[i]:  # rounding at the edge, try again
+                    continue
+                # wallpapers may have changed since their last update
+                self._set_weight(i, self._weight(self._store,
+                                                 self._wallpapers[i]._row,
+                                                 time.time()))
+                if self._weights[i]:
+                    break
+            self._hold_back(i)
+            return self._wallpapers[i]
+
+    def close(self):
+        self._store.changes.unsubscribe(self._update)
+
+    def _hold_back(self, i):
+        self._tree[i] = 0.0
+        self._recent.append(i)
+        self._held_back.add(i)
+        while len(self._recent) > self._max_recent:
+            j = self._recent.popleft()
+            self._held_back.discard(j)
+            self._tree[j] = self._weights[j]
+
+    def _release(self):
+        """Let held back wallpapers go early, oldest first, until one of
+        them has weight. Returns False if none has."""
+        while self._recent:
+            j = self._recent.popleft()
+            self._held_back.discard(j)
+            self._tree[j] = self._weights[j]
+            if self._weights[j]:
+                return True
+        return False
+
+    def _set_weight(self, i, weight):
+        self._weights[i] = weight
+        if i not in self._held_back:
+            self._tree[i] = weight
+
+    def _update(self, changes):
+        now = time.time()
+        with self._lock:
+            for row in changes:
+                i = self._index.get(row)
+                if i is not None:
+                    self._set_weight(i, self._weight(self._store, row, now))
+
+
+class AspectIndex:
+    """Wallpapers ordered by aspect ratio, to look up the ones suiting a
+    screen's shape without checking all of them."""
+
+    def __init__(self, wallpapers):
+        wallpapers = list(wallpapers)
+        aspects = [math.log(max(wp.width, 1) / max(wp.height, 1))
+                   for wp in wallpapers]
+        order = sorted(range(len(wallpapers)), key=aspects.__getitem__)
+        self._aspects = array('d', (aspects[i] for i in order))
+        self._wallpapers = [wallpapers[i] for i in order]
+
+    def candidates(self, width, height, tolerance=.15, min_scale=.75):
+        """Wallpapers whose aspect ratio is within tolerance of width/height,
+        preferring those at least min_scale times the given size.
+        If nothing fits the size requirement is dropped, then the aspect."""
+        target = math.log(width / height)
+        spread = math.log(1 + tolerance)
+        low = bisect_left(self._aspects, target - spread)
+        high = bisect_right(self._aspects, target + spread)
+        matching = self._wallpapers[low:high]
+        large = [wp for wp in matching if wp.width >= min_scale * width
+                                          and wp.height >= min_scale * height]
+        return large or matching or list(self._wallpapers)
@@ -3,34 +3,179 @@
 import subprocess
 import logging
 import re
+import threading
+import time
+import queue
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
 from dataclasses import dataclass
 
+from .render import RenderRequest, parse_resolutions
+from .setters import FehSetter
+from .sampler import WeightedSampler, AspectIndex
+from .wallpaper import find_invalid_paths, invalidate_paths
+
 log = logging.getLogger(__name__)
 
-def get_screens_data():
-    """Iterate data of all active screens by parsing `xrandr --query`."""
-    result = subprocess.run(("xrandr", "--query"),
+def query_xrandr(*options):
+    """Output of `xrandr --query` (or other options)"""
+    result = subprocess.run(("xrandr",) + (options or ("--query",)),
                             check=True, universal_newlines=True,
                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return result.stdout
+
+def parse_xrandr(output):
+    """Iterate data of all active screens in xrandr's output."""
     # kinda like sscanf
-    props = (('output', str), ('primary', bool), ('width', int), ('height', int))
-    regex = re.compile(r"^(\S+) connected( primary)? (\d+)x(\d+)",
+    props = (('output', str), ('primary', bool), ('width', int), ('height', int),
+             ('x', int), ('y', int))
+    regex = re.compile(r"^(\S+) connected( primary)? (\d+)x(\d+)\+(\d+)\+(\d+)",
                        flags=re.MULTILINE | re.ASCII)
-    for match in regex.findall(result.stdout):
+    for match in regex.findall(output):
         yield {name: type(value) for (name, type), value in zip(props, match)}
 
+def get_screens_data():
+    """Iterate data of all active screens by parsing `xrandr --query`."""
+    return parse_xrandr(query_xrandr())
+
+def parse_screen_sizes(string):
+    """Iterate data of screens with sizes like '1920x1080,2560x1440',
+    side by side from left to right. Like parse_xrandr, without X."""
+    x = 0
+    for idx, (width, height) in enumerate(parse_resolutions(string)):
+        yield {"output": "screen-{}".format(idx), "primary": idx == 0,
+               "width": width, "height": height, "x": x, "y": 0}
+        x += width
+
+
+class ScreenProbe:
+    """Watches for screens being connected, disconnected or reconfigured
+    by polling xrandr on a background thread. `xrandr --current` only asks
+    the X server and doesn't probe hardware, so it is cheap enough to
+    repeat every few seconds. Output is only parsed when it changed.
+    Both query and parser can be swapped, e.g. to replay recorded output.
+    """
+
+    def __init__(self, interval=3, query=lambda: query_xrandr("--current"),
+                 parser=parse_xrandr):
+        self.interval = interval
+        self._query = query
+        self._parser = parser
+        self._output = None
+        self._changed = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="probe",
+                                        daemon=True)
+        self._thread.start()
+
+    def take_changes(self):
+        """Screens data if it changed since the last call, else None.
+        The first probe only sets the baseline."""
+        with self._lock:
+            changed, self._changed = self._changed, None
+        return changed
+
+    def close(self):
+        self._closed.set()
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                output = self._query()
+            except Exception as e:
+                log.debug("Probing screens failed: %s", e)
+            else:
+                if output != self._output:
+                    data = list(self._parser(output))
+                    with self._lock:
+                        if self._output is not None:
+                            self._changed = data
+                        self._output = output
+            self._closed.wait(self.interval)
+
+
+class ValidatedSource:
+    """Hands out wallpapers from source once their paths have been checked.
+    Checks run ahead of time in batches on a background thread, with one
+    scandir per directory that has at least min_listed wallpapers in the
+    batch and a stat per file otherwise. Invalid paths are recorded as
+    batches are handed out, so the store is only modified by the consuming
+    thread."""
 
-def _feh_display_wallpapers(paths, primary=0):
-    """Low level wallpaper setter using feh"""
-    args = ("feh", "--bg-fill", "--no-fehbg", paths[primary]) + tuple(paths[:primary]) + tuple(paths[primary+1:])
-    try:
-        subprocess.run(args=args, check=True, universal_newlines=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as cpe:
-        log.warning("setting wallpapers failed '%s'", paths)
-        log.debug(cpe.output)
-        raise
+    def __init__(self, source, batch_size=16, lookahead=32, min_listed=8):
+        self._source = iter(source)
+        self._batch_size = batch_size
+        self._min_listed = min_listed
+        self._lookahead = lookahead
+        self._checked = queue.Queue()  # (batch, invalid paths), None at end
+        self._ready = deque()
+        self._exhausted = False
+        self._available = 0  # checked, not yet handed out
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="validate",
+                                        daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            while not self._ready:
+                if self._exhausted:
+                    raise StopIteration
+                checked = self._checked.get()
+                if checked is None:
+                    self._exhausted = True
+                    continue
+                batch, invalid = checked
+                invalidate_paths(invalid)
+                self._ready.extend(batch)
+            wp = self._ready.popleft()
+            with self._condition:
+                self._available -= 1
+                self._condition.notify()
+            if wp.paths:
+                return wp
+            log.warning("No valid paths left for wallpaper '%s'", wp.hash)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while (self._available >= self._lookahead
+                       and not self._closed):
+                    self._condition.wait()
+                if self._closed:
+                    return
+            try:
+                batch = list(islice(self._source, self._batch_size))
+            except Exception as e:
+                log.warning("Drawing wallpapers failed: %s", e)
+                with self._condition:  # try again in a moment
+                    self._condition.wait(1)
+                continue
+            try:
+                invalid = find_invalid_paths(batch,
+                                             min_listed=self._min_listed)
+            except Exception as e:
+                # better unchecked than lost
+                log.warning("Checking wallpaper paths failed: %s", e)
+                invalid = []
+            if not batch:
+                self._checked.put(None)
+                return
+            with self._condition:
+                self._available += len(batch)
+            self._checked.put((batch, invalid))
 
 
 class Collection:
@@ -39,6 +184,8 @@ class Collection:
     Maintains a current position in the collection and takes new items
     from a given source if required and possible. Otherwise cycles
     through previous entries.
+    Items taken ahead of time (see upcoming) are kept apart until they
+    are reached, so going back only ever shows previous entries.
     """
     @property
     def current(self):
@@ -46,7 +193,7 @@ class Collection:
             return self._items[self._position]
         except IndexError:
             try:
-                self.append(next(self._item_source))
+                self.append(self._take())
             except StopIteration:
                 self._position = 0
         return self._items[self._position]
@@ -54,11 +201,17 @@ class Collection:
     def __init__(self, item_source):
         self._item_source = item_source
         self._items = []
+        self._ahead = deque()  # taken from the source, not yet reached
         self._position = -1
 
     def __len__(self):
         return len(self._items)
 
+    def _take(self):
+        if self._ahead:
+            return self._ahead.popleft()
+        return next(self._item_source)
+
     def append(self, item):
         self._items.append(item)
         self._position = len(self._items) - 1
@@ -70,6 +223,23 @@ class Collection:
     def next(self):
         self._position += 1
 
+    def upcoming(self, count):
+        """Up to `count` items that next() will advance to, taking them
+        from the source ahead of time if required."""
+        self.current  # make sure position is valid
+        items = self._items[self._position + 1:]
+        while len(items) + len(self._ahead) < count:
+            try:
+                self._ahead.append(next(self._item_source))
+            except StopIteration:
+                break
+        items += self._ahead
+        # once the source has run out, previous entries come around again
+        cycle = self._items + list(self._ahead)
+        items += (cycle[i % len(cycle)]
+                  for i in range(max(0, count - len(items))))
+        return list(dict.fromkeys(items[:count]))
+
     def prev(self):
         self._position = (self._position - 1) % len(self._items)
 
@@ -85,6 +255,11 @@ class Screen:
     wallpapers: Collection
     primary: bool = False
     connected: bool = False
+    x: int = 0
+    y: int = 0
+    # (width, height, x, y) of this screen's part when spanning screens
+    canvas: tuple = None
+    paused: bool = False
 
     @property
     def wallpaper(self):
@@ -93,37 +268,269 @@ class Screen:
     @property
     def wallpaper_scale(self):
         wp = self.wallpaper
-        return wp.zoom * max(self.width / wp.width, self.height / wp.height)
+        width, height = self.canvas[:2] if self.canvas else (self.width,
+                                                             self.height)
+        return wp.zoom * max(width / wp.width, height / wp.height)
+
+    def render_item(self, wp, cache, variants=None, count=False):
+        """What to display wp on this screen: A path, or a RenderRequest
+        if it still needs to be rendered (see Wallpaper.transformed)."""
+        return wp.transformed(self.width, self.height, cache, variants,
+                              self.canvas, count)
+
+
+class Prefetcher:
+    """Renders upcoming wallpapers of all screens in the background,
+    so stepping forward is just a cache lookup."""
+
+    def __init__(self, render_cache, lookahead=2, workers=2):
+        self.lookahead = lookahead
+        self._render_cache = render_cache
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="prefetch")
+        self._futures = {}  # Future -> RenderRequest
+
+    def prefetch(self, screens):
+        self._futures = {future: request
+                         for future, request in self._futures.items()
+                         if not future.done()}
+        for screen in screens:
+            for wp in screen.wallpapers.upcoming(self.lookahead):
+                item = screen.render_item(wp, self._render_cache)
+                if isinstance(item, RenderRequest):
+                    future = self._render_cache.submit(item, self._executor)
+                    self._futures[future] = item
+
+    def retarget(self, screens):
+        """Drop queued renders for screen geometries that are gone."""
+        targets = {(s.width, s.height, s.canvas) for s in screens}
+        for future, request in self._futures.items():
+            if ((request.width, request.height, request.canvas) not in targets
+                    and not future.done()):
+                self._render_cache.cancel(request)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncDisplay:
+    """Renders and sets wallpapers on a worker thread.
+    Requests supersede each other: A request made while another one is
+    pending replaces it and one that is still rendering is abandoned
+    before reaching the screen. Only the latest state is displayed."""
+
+    def __init__(self, render_cache, setter=None, workers=4):
+        self._render_cache = render_cache
+        self._setter = setter or FehSetter()
+        # separate from the prefetcher's pool so we never queue behind it
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="render")
+        self._live_paths = None
+        self._pending = None
+        self._generation = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="display",
+                                        daemon=True)
+        self._thread.start()
+
+    def request(self, items, screens):
+        """Display items, which are paths or RenderRequests, one per screen."""
+        with self._condition:
+            self._generation += 1
+            self._pending = self._generation, items, screens
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _superseded(self, generation):
+        return generation != self._generation or self._closed
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                (generation, items, screens), self._pending = self._pending, None
+            try:
+                self._display(generation, items, screens)
+            except Exception as e:
+                log.warning("Displaying wallpapers failed: %s", e)
+        self._setter.close()
+
+    def _display(self, generation, items, screens):
+        """Render all screens in parallel, then set them all at once."""
+        futures = []
+        for item in items:
+            if isinstance(item, RenderRequest):
+                futures.append(self._render_cache.submit(item, self._executor,
+                                                         count=True))
+            else:
+                future = Future()
+                future.set_result(item)
+                futures.append(future)
+        not_done = futures
+        while not_done:
+            if self._superseded(generation):
+                # don't keep workers busy with renders no one will see
+                for item, future in zip(items, futures):
+                    if future in not_done:
+                        self._render_cache.cancel(item)
+                return
+            _, not_done = wait(not_done, timeout=0.1)
+        paths = tuple(future.result() for future in futures)
+        if paths != self._live_paths and not self._superseded(generation):
+            self._live_paths = paths
+            self._setter.set(paths, screens)
 
 
 class ScreenController:
-    """Manage available screens, cycling through them, pausing etc."""
-
-    def __init__(self, wallpaper_controller):
-        wallpaper_source = iter(wp for wp in wallpaper_controller.wallpapers
-                                if wp.check_paths())
-        self.screens = tuple(Screen(idx=i,
-                                    wallpapers=Collection(wallpaper_source),
-                                    **data)
-                             for i, data in enumerate(get_screens_data()))
+    """Manage available screens, cycling through them, pausing etc.
+    In span mode all screens share one collection and each shows its part
+    of the wallpaper stretched across the screens' layout. Every screen
+    renders from the same decoded image.
+    Wallpapers without transformations are shown as pre-rendered for the
+    screen's size if variants (a RenderCache) has them.
+    Screens are found with xrandr unless screens_data (as returned by
+    get_screens_data) and a probe watching them for changes are given."""
+
+    def __init__(self, wallpaper_controller, render_cache, span=False,
+                 setter=None, variants=None, screens_data=None, probe=None):
+        self._wpctrl = wallpaper_controller
+        self._index = AspectIndex(wallpaper_controller.wallpapers)
+        self._sources = {}  # (width, height) -> ValidatedSource
+        self.span = span
+        self._span_size = None
+        self.screens = ()
+        if screens_data is None:
+            screens_data = get_screens_data()
+        self._set_screens(screens_data)
         if self.screens:
             log.debug("Found %d screens.", len(self.screens))
         else:
             raise Exception("No screens found.")
-        self._primary_idx = next(s for s in self.screens if s.primary).idx
-        self._live_wallpaper_paths = None
+        self.probe = probe or ScreenProbe()
+        self.render_cache = render_cache
+        self.variants = variants
+        self.prefetcher = Prefetcher(render_cache)
+        self._display = AsyncDisplay(render_cache, setter)
+
+    def _source(self, width, height):
+        """Wallpapers suiting a screen of the given size. Screens of equal
+        size share a source, so they don't show the same wallpapers."""
+        try:
+            return self._sources[width, height]
+        except KeyError:
+            pass
+        candidates = self._index.candidates(width, height)
+        log.debug("%d wallpapers suit %dx%d.", len(candidates), width, height)
+        if self._wpctrl.sort:
+            candidates = set(candidates)
+            candidates = iter([wp for wp in self._wpctrl.wallpapers
+                               if wp in candidates])
+        else:
+            candidates = WeightedSampler(candidates)
+        self._sources[width, height] = ValidatedSource(candidates)
+        return self._sources[width, height]
+
+    def _set_screens(self, screens_data):
+        """(Re)build screens from data as returned by get_screens_data.
+        Screens that keep their output and size keep their wallpapers."""
+        previous = {screen.output: screen for screen in self.screens}
+        screens = []
+        for idx, data in enumerate(screens_data):
+            screen = Screen(idx=idx, wallpapers=None, **data)
+            old = previous.get(screen.output)
+            if old and (old.width, old.height) == (screen.width, screen.height):
+                screen.wallpapers = old.wallpapers
+                screen.paused = old.paused
+            screens.append(screen)
+        self.screens = tuple(screens)
+        if not screens:
+            return
+        if self.span:
+            self._layout_span()
+            canvas_size = screens[0].canvas[:2]
+            if canvas_size != self._span_size:
+                self._span_size = canvas_size
+                self._span_wallpapers = Collection(self._source(*canvas_size))
+            for screen in screens:
+                screen.wallpapers = self._span_wallpapers
+        else:
+            for screen in screens:
+                if screen.wallpapers is None:
+                    screen.wallpapers = Collection(
+                                self._source(screen.width, screen.height))
+
+    def update_screens(self):
+        """Apply changes found by the probe. Returns True if screens were
+        added, removed or changed."""
+        screens_data = self.probe.take_changes()
+        if screens_data is None:
+            return False
+        log.info("Screens changed: %s",
+                 ", ".join("{output} {width}x{height}".format(**data)
+                           for data in screens_data) or "none left")
+        self._set_screens(screens_data)
+        if self.screens:
+            self.prefetcher.retarget(self.screens)
+            self.display_wallpapers()
+        return True
+
+    def _layout_span(self):
+        """Place every screen on a canvas covering all of them."""
+        left = min(screen.x for screen in self.screens)
+        top = min(screen.y for screen in self.screens)
+        width = max(screen.x + screen.width for screen in self.screens) - left
+        height = max(screen.y + screen.height for screen in self.screens) - top
+        for screen in self.screens:
+            screen.canvas = width, height, screen.x - left, screen.y - top
 
     def display_wallpapers(self):
-        """Put currently selected wallpapers live on screens."""
-        paths = tuple(screen.wallpaper.transformed(screen.width, screen.height)
-                      for screen in self.screens)
-        if paths != self._live_wallpaper_paths:
-            self._live_wallpaper_paths = paths
-            _feh_display_wallpapers(paths, primary=self._primary_idx)
-            for screen in self.screens:
-                screen.wallpaper.increment_views()
+        """Put currently selected wallpapers live on screens.
+        Rendering happens in the background, this returns immediately."""
+        items = []
+        for screen in self.screens:
+            wp = screen.wallpaper
+            items.append(screen.render_item(wp, self.render_cache,
+                                            self.variants, count=True))
+            wp.increment_views()
+        self._display.request(tuple(items), self.screens)
+        self.prefetcher.prefetch(self.screens)
+
+    def advance(self, screens=None):
+        """Step screens (default: all) that aren't paused to their next
+        wallpaper. Returns False if there was nothing to do."""
+        if screens is None:
+            screens = self.screens
+        collections = {id(s.wallpapers): s.wallpapers
+                       for s in screens if not s.paused}
+        if not collections:
+            return False
+        for collection in collections.values():
+            collection.next()
+        self.display_wallpapers()
+        return True
+
+    def prefetch(self):
+        self.prefetcher.prefetch(self.screens)
+
+    def shutdown(self):
+        self.probe.close()
+        self._display.close()
+        self.prefetcher.shutdown()
+        for source in self._sources.values():
+            source.close()
 
     def cycle_collections(self):
+        if not self.screens:
+            return
         first = self.screens[0].wallpapers
         for s1, s2 in zip(self.screens, self.screens[1:]):
             s1.wallpapers = s2.wallpapers
@@ -131,6 +538,9 @@ class ScreenController:
         self.display_wallpapers()
 
     def move_wallpaper(self, from_idx, to_idx):
+        if self.span:
+            log.info("All screens show the same wallpaper in span mode.")
+            return
         try:
             to_collection = self.screens[to_idx].wallpapers
         except IndexError:
@@ -140,3 +550,70 @@ class ScreenController:
             to_collection.append(from_collection.current)
             from_collection.remove_current()
             self.display_wallpapers()
+
+
+class Cycler:
+    """Advances screens every `interval` seconds on a steady clock.
+    Every screen keeps its own tick, so it can be restarted after the
+    screen was changed by hand without cutting that short.
+    Upcoming wallpapers are rendered ahead of the next tick, early enough
+    given how long renders take, so switching is just a cache hit.
+    Missed ticks (e.g. while suspended) are skipped rather than caught up.
+    """
+
+    def __init__(self, screen_controller, interval, clock=time.monotonic):
+        self.interval = interval
+        self._scrctrl = screen_controller
+        self._clock = clock
+        self._next_ticks = {screen.output: clock() + interval
+                            for screen in screen_controller.screens}
+        self._prepared = None  # tick that was prefetched for
+
+    @property
+    def lead_time(self):
+        render_time = self._scrctrl.render_cache.render_time
+        return min(self.interval / 2, 2 * render_time + .1)
+
+    def _next_tick(self, screen):
+        # screens connected later start their first interval when seen
+        return self._next_ticks.setdefault(screen.output,
+                                           self._clock() + self.interval)
+
+    def restart(self, screen):
+        """Count a full interval from now until screen advances, and the
+        same for screens sharing its wallpapers."""
+        next_tick = self._clock() + self.interval
+        for s in self._scrctrl.screens:
+            if s.wallpapers is screen.wallpapers:
+                self._next_ticks[s.output] = next_tick
+
+    def poll(self, held=()):
+        """Do whatever is due. Screens in held (or sharing their wallpapers)
+        aren't advanced but miss their tick, e.g. while being edited.
+        Returns (whether screens were advanced, seconds until the next
+        call)."""
+        now = self._clock()
+        screens = self._scrctrl.screens
+        due = [s for s in screens if now >= self._next_tick(s)]
+        advanced = False
+        if due:
+            held = {id(s.wallpapers) for s in held}
+            advanced = self._scrctrl.advance(
+                        [s for s in due if id(s.wallpapers) not in held])
+            for screen in due:
+                next_tick = self._next_tick(screen)
+                missed = (now - next_tick) // self.interval
+                if missed:
+                    log.debug("Skipping %d missed ticks of %s.",
+                              missed, screen.output)
+                next_tick += (missed + 1) * self.interval
+                self._next_ticks[screen.output] = next_tick
+        if not screens:
+            return advanced, self.interval
+        next_tick = min(map(self._next_tick, screens))
+        prepare_at = next_tick - self.lead_time
+        if self._prepared != next_tick and now >= prepare_at:
+            self._scrctrl.prefetch()
+            self._prepared = next_tick
+        due = next_tick if self._prepared == next_tick else prepare_at
+        return advanced, max(0, due - now)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Backends for putting wallpapers on screens."""
+
+import subprocess
+import logging
+import time
+
+from PIL import Image, ImageOps
+
+try:
+    from Xlib import X, Xatom, display as xdisplay
+except ImportError:
+    xdisplay = None
+
+log = logging.getLogger(__name__)
+
+
+class Setter:
+    """Puts one image per screen on the desktop.
+    paths and screens are sequences of equal length."""
+
+    def set(self, paths, screens):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FehSetter(Setter):
+    """Runs feh for every change."""
+
+    def set(self, paths, screens):
+        primary = next((i for i, s in enumerate(screens) if s.primary), 0)
+        args = ("feh", "--bg-fill", "--no-fehbg", paths[primary]) + tuple(paths[:primary]) + tuple(paths[primary+1:])
+        try:
+            subprocess.run(args=args, check=True, universal_newlines=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as cpe:
+            log.warning("setting wallpapers failed '%s'", paths)
+            log.debug(cpe.output)
+            raise
+
+
+class XlibSetter(Setter):
+    """Draws onto the root window through one long-lived X connection,
+    so no process is started per change. Requires python-xlib.
+    Like feh --bg-fill, images are scaled and cropped to fill their screen.
+    """
+
+    def __init__(self):
+        if xdisplay is None:
+            raise Exception("The xlib setter requires python-xlib.")
+        self._display = xdisplay.Display()
+        self._screen = self._display.screen()
+        self._atoms = [self._display.intern_atom(name)
+                       for name in ("_XROOTPMAP_ID", "ESETROOT_PMAP_ID")]
+        self._pixmap = None
+        # the last wallpaper stays after we exit, like with other setters
+        self._display.set_close_down_mode(X.RetainPermanent)
+
+    def set(self, paths, screens):
+        root = self._screen.root
+        width = self._screen.width_in_pixels
+        height = self._screen.height_in_pixels
+        pixmap = root.create_pixmap(width, height, self._screen.root_depth)
+        gc = pixmap.create_gc(foreground=self._screen.black_pixel)
+        pixmap.fill_rectangle(gc, 0, 0, width, height)
+        for path, screen in zip(paths, screens):
+            size = screen.width, screen.height
+            with Image.open(path) as img:
+                img.draft("RGB", size)
+                img = ImageOps.fit(img.convert("RGB"), size, Image.LANCZOS)
+            pixmap.put_pil_image(gc, screen.x, screen.y, img)
+        gc.free()
+        if self._pixmap is None:
+            foreign = self._foreign_pixmap()
+        for atom in self._atoms:
+            root.change_property(atom, Xatom.PIXMAP, 32, [pixmap.id])
+        root.change_attributes(background_pixmap=pixmap)
+        root.clear_area(0, 0, width, height)
+        if self._pixmap is not None:
+            self._pixmap.free()
+        elif foreign:
+            # free what a previous setter left behind
+            self._display.create_resource_object("pixmap", foreign).kill_client()
+        self._pixmap = pixmap
+        self._display.flush()
+
+    def _foreign_pixmap(self):
+        """Id of a root pixmap set by someone else that can be freed."""
+        ids = []
+        for atom in self._atoms:
+            prop = self._screen.root.get_full_property(atom, Xatom.PIXMAP)
+            ids.append(prop.value[0] if prop and prop.value else None)
+        return ids[0] if ids[0] and ids[0] == ids[1] else None
+
+    def close(self):
+        self._display.close()
+
+
+class RecordingSetter(Setter):
+    """Leaves the screen alone and only remembers when which paths were
+    set. Useful on headless machines, for testing and benchmarks."""
+
+    def __init__(self):
+        self.calls = []  # (time.monotonic(), paths)
+
+    def set(self, paths, screens):
+        self.calls.append((time.monotonic(), tuple(paths)))
+
+
+SETTERS = {
+    "feh": FehSetter,
+    "xlib": XlibSetter,
+    "none": RecordingSetter,
+}
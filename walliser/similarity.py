@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Finding wallpapers that look alike, even at different sizes."""
+
+from itertools import combinations
+from functools import lru_cache
+
+from PIL import Image, ImageChops
+
+# Difference hashes have HASH_SIZE**2 bits, one per pixel of a tiny
+# greyscale thumbnail telling whether it is brighter than its right
+# neighbour. Similar images have hashes differing in few bits.
+HASH_SIZE = 8
+
+# Hashes differing in at most this many bits count as near-duplicates.
+MAX_DISTANCE = 10
+
+
+def hamming(a, b):
+    """Number of differing bits"""
+    return bin(a ^ b).count("1")
+
+
+def dhash_images(images):
+    """Difference hashes of a batch of images, 0 for those that are None.
+    Thumbnails of all images are stacked into one strip so the comparison
+    and packing of bits is done once per batch."""
+    strip = Image.new("L", (HASH_SIZE + 1, HASH_SIZE * len(images)))
+    for i, img in enumerate(images):
+        if img is not None:  # otherwise all zero, like a flat image
+            strip.paste(img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE),
+                                                resample=Image.BOX),
+                        (0, i * HASH_SIZE))
+    left = strip.crop((0, 0, HASH_SIZE, strip.height))
+    right = strip.crop((1, 0, HASH_SIZE + 1, strip.height))
+    # one bit per pixel, HASH_SIZE bits make one byte per row
+    bits = ImageChops.subtract(left, right).point(lambda v: 255 if v else 0,
+                                                  "1").tobytes()
+    size = HASH_SIZE**2 // 8
+    return [int.from_bytes(bits[i:i + size], "big")
+            for i in range(0, len(bits), size)]
+
+
+class HammingIndex:
+    """Multi-index hash table of items by hash, for finding all items within
+    a small hamming distance of a hash without comparing against all of them.
+    Hashes are split into chunks with one table each. Of two hashes within
+    distance d, at least one chunk differs in no more than d // chunks bits,
+    so only those few neighbouring chunk values need to be looked up.
+    """
+
+    def __init__(self, items=(), bits=HASH_SIZE**2, chunks=4):
+        self._width = bits // chunks
+        self._shifts = [i * self._width for i in range(chunks)]
+        self._mask = (1 << self._width) - 1
+        self._tables = [{} for _ in range(chunks)]
+        self._hashes = []
+        self._items = []
+        for hash, item in items:
+            self.add(hash, item)
+
+    def add(self, hash, item):
+        i = len(self._items)
+        self._hashes.append(hash)
+        self._items.append(item)
+        for shift, table in zip(self._shifts, self._tables):
+            table.setdefault(hash >> shift & self._mask, []).append(i)
+
+    def find(self, hash, max_distance=MAX_DISTANCE):
+        """[(distance, item), ...] of all items within max_distance"""
+        flips = _flips(self._width, max_distance // len(self._tables))
+        candidates = set()
+        for shift, table in zip(self._shifts, self._tables):
+            chunk = hash >> shift & self._mask
+            for flip in flips:
+                candidates.update(table.get(chunk ^ flip, ()))
+        found = []
+        for i in candidates:
+            distance = hamming(hash, self._hashes[i])
+            if distance <= max_distance:
+                found.append((distance, self._items[i]))
+        return found
+
+@lru_cache()
+def _flips(width, max_bits):
+    """All masks of width bits with at most max_bits set."""
+    return tuple(sum(1 << bit for bit in combination)
+                 for bits in range(max_bits + 1)
+                 for combination in combinations(range(width), bits))
+
+
+def group_similar(hashes, max_distance=MAX_DISTANCE):
+    """Group items of {item: hash} that are within max_distance of each
+    other. Items join the group of the first item they are close to, so
+    chains of slightly different images don't merge into one group.
+    Returns a list of groups with more than one item."""
+    index = HammingIndex((hash, item) for item, hash in hashes.items())
+    grouped = set()
+    groups = []
+    for item, hash in hashes.items():
+        if item in grouped:
+            continue
+        group = [other for _, other in sorted(index.find(hash, max_distance),
+                                              key=lambda found: found[0])
+                 if other not in grouped]
+        grouped.update(group)
+        if len(group) > 1:
+            groups.append(group)
+    return groups
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+import os
+from array import array
+from collections.abc import MutableMapping
+from datetime import datetime
+import logging
+
+from .similarity import HammingIndex, MAX_DISTANCE
+from .features import COLOR_BYTES
+
+log = logging.getLogger(__name__)
+
+DIGEST_SIZE = 20  # sha1
+
+# bit masks for every stored field, used to track changes
+FIELDS = ("paths", "invalid_paths", "format", "width", "height",
+          "added", "modified", "views", "rating", "purity", "tags",
+          "x_offset", "y_offset", "zoom", "transformations",
+          "file_size", "verified", "phash", "colors")
+FIELD = {name: 1 << bit for bit, name in enumerate(FIELDS)}
+ALL_FIELDS = (1 << len(FIELDS)) - 1
+
+def field_mask(fields):
+    mask = 0
+    for field in fields:
+        mask |= FIELD[field]
+    return mask
+
+
+def pack_transformations(transformations):
+    """(flip_horizontal, flip_vertical, rotate) -> small int"""
+    horizontal, vertical, rotate = transformations
+    return bool(horizontal) | bool(vertical) << 1 | (rotate // 90 % 4) << 2
+
+def unpack_transformations(packed):
+    """small int -> (flip_horizontal, flip_vertical, rotate)"""
+    return bool(packed & 1), bool(packed & 2), (packed >> 2) * 90
+
+
+def _flatten(pairs):
+    return tuple(item for pair in pairs for item in pair)
+
+
+class ChangeBus:
+    """Central record of which fields of which rows have changed.
+
+    Changes are tracked twice: As a field mask per row of everything not
+    yet saved, and as a batch of changes not yet published to subscribers.
+    Subscribers are called with whole batches of {row: field mask}.
+    """
+
+    def __init__(self):
+        self.unsaved = array('I')  # field mask per row, 0 means clean
+        self._unsaved_rows = []
+        self._batch = {}
+        self._subscribers = []
+
+    def add_row(self):
+        self.unsaved.append(0)
+
+    def mark(self, row, mask):
+        if not self.unsaved[row]:
+            self._unsaved_rows.append(row)
+        self.unsaved[row] |= mask
+        self._batch[row] = self._batch.get(row, 0) | mask
+
+    @property
+    def unsaved_count(self):
+        return len(self._unsaved_rows)
+
+    def take_unsaved(self):
+        """Return {row: field mask} of unsaved changes and consider them
+        saved."""
+        changes = {row: self.unsaved[row] for row in self._unsaved_rows}
+        for row in self._unsaved_rows:
+            self.unsaved[row] = 0
+        self._unsaved_rows = []
+        return changes
+
+    def subscribe(self, callback, fields=ALL_FIELDS):
+        """Get called with batches of changes to any of the given fields."""
+        self._subscribers.append((callback, fields))
+
+    def unsubscribe(self, callback):
+        self._subscribers = [(cb, fields) for cb, fields in self._subscribers
+                             if cb != callback]
+
+    def publish(self):
+        """Notify subscribers of all changes since the last call."""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, {}
+        for callback, fields in self._subscribers:
+            changes = {row: mask & fields for row, mask in batch.items()
+                       if mask & fields}
+            if changes:
+                callback(changes)
+
+
+class WallpaperStore(MutableMapping):
+    """Column oriented storage of wallpaper data.
+    Every wallpaper occupies one row across a number of typed arrays.
+    Digests are stored in binary, formats and tags are interned.
+    Wallpaper objects are only thin views onto a row (see wallpaper.py).
+
+    As a mapping the store presents itself as {hex digest: JSON data},
+    which is how it is written to the config file.
+    """
+
+    # optional attributes: (name, default) - omitted from JSON if default
+    optional_attributes = (
+        ("views", 0),
+        ("rating", 0),
+        ("purity", 0),
+        ("tags", ()),
+        ("x_offset", 0),
+        ("y_offset", 0),
+        ("zoom", 1.0),
+        ("transformations", (False, False, 0)),
+        ("file_size", 0),
+        ("verified", None),
+        ("phash", 0),
+        ("colors", None),
+    )
+
+    def __init__(self):
+        self._rows = {}  # binary digest -> row index
+        self.changes = ChangeBus()
+
+        self.digests = bytearray()
+        self.paths = []  # flat tuples: (directory id, file name, ...)
+        self.invalid_paths = {}  # sparse, row -> list of paths
+        self.format = array('B')
+        self.width = array('I')
+        self.height = array('I')
+        self.added = array('d')
+        self.modified = array('d')
+        self.views = array('I')
+        self.views_incremented = bytearray()
+        self.rating = array('h')
+        self.purity = array('h')
+        self.tags = []
+        self.x_offset = array('i')
+        self.y_offset = array('i')
+        self.zoom = array('d')
+        self.transformations = array('B')
+        # signature of the files' content at the time it was last hashed
+        self.file_size = array('Q')
+        self.verified = array('d')  # timestamp, 0 if unknown
+        # perceptual hash of the content (see similarity.py), 0 if unknown
+        self.phash = array('Q')
+        self._phash_index = None  # HammingIndex of rows, built on demand
+        # packed colour features (see features.py), all zero if unknown
+        self.colors = bytearray()
+
+        self.directories = []
+        self._directory_ids = {}
+        self.format_names = []
+        self._format_ids = {}
+        self.tag_names = []
+        self._tag_ids = {}
+        self._tag_tuples = {}
+
+    def mark_changed(self, row, mask):
+        """Record a user modification of the given fields."""
+        self.modified[row] = datetime.now().timestamp()
+        self.changes.mark(row, mask | FIELD["modified"])
+
+    def add(self, hash, paths, format, width, height, added, modified,
+            invalid_paths=None, views=0, rating=0, purity=0, tags=(),
+            x_offset=0, y_offset=0, zoom=1.0,
+            transformations=(False, False, 0), file_size=0, verified=None,
+            phash=0, colors=None):
+        """Add a wallpaper and return its row index. If the wallpaper is
+        already known only its paths are merged."""
+        digest = bytes.fromhex(hash)
+        paths = list(map(self.split_path, paths))
+        try:
+            row = self._rows[digest]
+        except KeyError:
+            pass
+        else:
+            known_paths = self.path_pairs(row)
+            if not set(paths) <= set(known_paths):
+                self._set_paths(row, sorted(set(known_paths) | set(paths),
+                                            key=self.join_path))
+            return row
+
+        row = len(self.width)
+        self._rows[digest] = row
+        self.digests += digest
+        self.paths.append(_flatten(paths))
+        if invalid_paths:
+            self.invalid_paths[row] = list(invalid_paths)
+        self.format.append(self._intern_format(format))
+        self.width.append(width)
+        self.height.append(height)
+        self.added.append(added.timestamp())
+        self.modified.append(modified.timestamp())
+        self.views.append(views)
+        self.views_incremented.append(False)
+        self.rating.append(rating)
+        self.purity.append(purity)
+        self.tags.append(self.intern_tags(tags))
+        self.x_offset.append(x_offset)
+        self.y_offset.append(y_offset)
+        self.zoom.append(zoom)
+        self.transformations.append(pack_transformations(transformations))
+        self.file_size.append(file_size)
+        self.verified.append(verified.timestamp() if verified else 0.0)
+        self.phash.append(phash)
+        self.colors += bytes.fromhex(colors) if colors else bytes(COLOR_BYTES)
+        self._phash_index = None
+        self.changes.add_row()
+        return row
+
+    def split_path(self, path):
+        """Turn a path into (directory id, file name)."""
+        directory, name = os.path.split(path)
+        try:
+            return self._directory_ids[directory], name
+        except KeyError:
+            self._directory_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+            return self._directory_ids[directory], name
+
+    def join_path(self, directory_and_name):
+        directory_id, name = directory_and_name
+        return os.path.join(self.directories[directory_id], name)
+
+    def path_pairs(self, row):
+        """[(directory id, file name), ...] of a row"""
+        flat = self.paths[row]
+        return list(zip(flat[::2], flat[1::2]))
+
+    def _set_paths(self, row, path_pairs):
+        self.paths[row] = _flatten(path_pairs)
+
+    def get_paths(self, row):
+        return tuple(map(self.join_path, self.path_pairs(row)))
+
+    def primary_path(self, row):
+        flat = self.paths[row]
+        if flat:
+            return os.path.join(self.directories[flat[0]], flat[1])
+        return None
+
+    def path_index(self):
+        """{(directory id, file name): row} for all known paths"""
+        return {path: row for row in self.rows()
+                          for path in self.path_pairs(row)}
+
+    def rows_by_directory(self, rows):
+        """Group rows' paths by directory: {directory id: [(row, name), ...]}"""
+        directories = {}
+        for row in rows:
+            for directory_id, name in self.path_pairs(row):
+                directories.setdefault(directory_id, []).append((row, name))
+        return directories
+
+    def _intern_format(self, format):
+        try:
+            return self._format_ids[format]
+        except KeyError:
+            self._format_ids[format] = len(self.format_names)
+            self.format_names.append(format)
+            return self._format_ids[format]
+
+    def intern_tags(self, tags):
+        """Turn tag names into an (interned) tuple of tag ids."""
+        ids = []
+        for tag in tags:
+            try:
+                ids.append(self._tag_ids[tag])
+            except KeyError:
+                self._tag_ids[tag] = len(self.tag_names)
+                self.tag_names.append(tag)
+                ids.append(self._tag_ids[tag])
+        ids = tuple(ids)
+        return self._tag_tuples.setdefault(ids, ids)
+
+    def row(self, hash):
+        return self._rows[bytes.fromhex(hash)]
+
+    def rows(self):
+        """Iterate row indices of all (not deleted) wallpapers."""
+        return iter(self._rows.values())
+
+    def digest(self, row):
+        return bytes(self.digests[row * DIGEST_SIZE:(row + 1) * DIGEST_SIZE])
+
+    def get_tags(self, row):
+        return tuple(self.tag_names[tag_id] for tag_id in self.tags[row])
+
+    def get_transformations(self, row):
+        return unpack_transformations(self.transformations[row])
+
+    def remove_path(self, row, path):
+        split_path = self.split_path(path)
+        self._set_paths(row, (p for p in self.path_pairs(row)
+                              if p != split_path))
+
+    def invalidate_path(self, row, path):
+        self.remove_path(row, path)
+        invalid_paths = self.invalid_paths.setdefault(row, [])
+        if path not in invalid_paths:
+            invalid_paths.append(path)
+
+    def set_phash(self, row, phash):
+        self.phash[row] = phash
+        self._phash_index = None
+        self.changes.mark(row, FIELD["phash"])
+
+    def get_colors(self, row):
+        """Packed colour features of a row, None if unknown."""
+        colors = bytes(self.colors[row * COLOR_BYTES:(row + 1) * COLOR_BYTES])
+        return colors if any(colors) else None
+
+    def set_colors(self, row, colors):
+        self.colors[row * COLOR_BYTES:(row + 1) * COLOR_BYTES] = colors
+        self.changes.mark(row, FIELD["colors"])
+
+    def similar_rows(self, row, max_distance=MAX_DISTANCE):
+        """Other rows whose perceptual hash is within max_distance."""
+        if not self.phash[row]:
+            return []
+        if self._phash_index is None:
+            self._phash_index = HammingIndex((self.phash[r], r)
+                                             for r in self.rows()
+                                             if self.phash[r])
+        return [other for _, other in self._phash_index.find(self.phash[row],
+                                                             max_distance)
+                if other != row]
+
+    def to_json(self, row, fields=None):
+        """Dictionary representation of a row for storing.
+        Excludes hash so it can be used as key.
+        If a field mask is given only those fields are included, even
+        if they have default values, unless they are unknown (None).
+        """
+        if fields is not None:
+            full = self.to_json(row)
+            defaults = dict(self.optional_attributes, invalid_paths=[])
+            partial = {name: full.get(name, defaults.get(name))
+                       for name in FIELDS if fields & FIELD[name]}
+            # unknown values are better left out than stored as null
+            return {name: value for name, value in partial.items()
+                    if value is not None}
+        # simple attributes, always present
+        data = {
+            'paths': list(self.get_paths(row)),
+            'format': self.format_names[self.format[row]],
+            'width': self.width[row],
+            'height': self.height[row],
+            'added': datetime.fromtimestamp(self.added[row]),
+            'modified': datetime.fromtimestamp(self.modified[row]),
+        }
+        # attributes with common defaults may not need to be stored
+        for attr, default in self.optional_attributes:
+            if attr == 'tags':
+                value = self.get_tags(row)
+            elif attr == 'transformations':
+                value = self.get_transformations(row)
+            elif attr == 'colors':
+                value = self.get_colors(row)
+                value = value and value.hex()
+            elif attr == 'verified':
+                value = (datetime.fromtimestamp(self.verified[row])
+                         if self.verified[row] else None)
+            else:
+                value = getattr(self, attr)[row]
+            if value != default:
+                data[attr] = value
+        if self.invalid_paths.get(row):
+            data['invalid_paths'] = self.invalid_paths[row]
+        return data
+
+    # MutableMapping interface, {hex digest: JSON data}
+
+    def __getitem__(self, hash):
+        return self.to_json(self.row(hash))
+
+    def __setitem__(self, hash, data):
+        try:
+            del self[hash]
+        except KeyError:
+            pass
+        self.add(hash, **data)
+
+    def __delitem__(self, hash):
+        """Deleted rows are simply forgotten, their space is not reused."""
+        del self._rows[bytes.fromhex(hash)]
+        self._phash_index = None
+
+    def __contains__(self, hash):
+        return bytes.fromhex(hash) in self._rows
+
+    def __iter__(self):
+        return (digest.hex() for digest in self._rows)
+
+    def __len__(self):
+        return len(self._rows)
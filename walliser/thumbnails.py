@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Small previews of wallpapers, kept on disk."""
+
+import os
+import logging
+import multiprocessing
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from PIL import Image
+
+from .render import default_cache_dir, _flattened
+from .progress import progress
+
+log = logging.getLogger(__name__)
+
+# longest side in pixels
+THUMBNAIL_SIZE = 256
+
+
+def make_thumbnail(path, destination, size):
+    """Worker: Write a JPEG of the image at path that fits into a square of
+    the given size. Returns the number of bytes written, 0 on failure."""
+    try:
+        with Image.open(path) as img:
+            # JPEGs are decoded at reduced size right away
+            img.draft("RGB", (size, size))
+            img.thumbnail((size, size), resample=Image.LANCZOS,
+                          reducing_gap=2.0)
+            if img.mode not in ("RGB", "L"):
+                img = _flattened(img)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination),
+                                            prefix=".", suffix=".jpg")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    img.save(f, format="JPEG", quality=85)
+                os.replace(tmp_path, destination)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return 0
+    return os.path.getsize(destination)
+
+
+class ThumbnailCache:
+    """Thumbnails of wallpapers on disk. Files are named by wallpaper hash
+    and spread over subdirectories by its first two digits, so identical
+    wallpapers share a thumbnail and no directory grows too large.
+    Missing thumbnails are created in batches on a process pool. When the
+    total size exceeds max_bytes the least recently used ones are evicted.
+    Thread safe.
+    """
+
+    def __init__(self, directory=None, size=THUMBNAIL_SIZE,
+                 max_bytes=128 * 2**20, workers=None):
+        self.directory = directory or os.path.join(
+                                default_cache_dir("thumbnails"), str(size))
+        self.size = size
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._entries = OrderedDict()  # hash -> size, least recent first
+        self._size = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def __str__(self):
+        return "{} thumbnails, {:.1f} MiB".format(len(self._entries),
+                                                  self._size / 2**20)
+
+    def _scan(self):
+        """Pick up thumbnails from previous sessions, ordered by last use."""
+        entries = []
+        with os.scandir(self.directory) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as dir_entries:
+                    for entry in dir_entries:
+                        if entry.name.startswith("."):  # unfinished write
+                            continue
+                        stat = entry.stat()
+                        hash = os.path.splitext(entry.name)[0]
+                        entries.append((stat.st_mtime, hash, stat.st_size))
+        for _, hash, size in sorted(entries):
+            self._entries[hash] = size
+            self._size += size
+        self._evict()
+
+    def _path(self, hash):
+        return os.path.join(self.directory, hash[:2], hash + ".jpg")
+
+    def _lookup(self, hash):
+        """Path of a cached thumbnail or None. Call with lock held."""
+        if hash not in self._entries:
+            return None
+        path = self._path(hash)
+        try:
+            os.utime(path)  # remember usage across sessions
+        except FileNotFoundError:
+            self._size -= self._entries.pop(hash)
+            return None
+        self._entries.move_to_end(hash)
+        return path
+
+    def get(self, wallpapers, show_progress=False):
+        """Thumbnail paths of wallpapers, creating missing thumbnails.
+        None for wallpapers that can't be read."""
+        wallpapers = list(wallpapers)
+        hashes = [wp.hash for wp in wallpapers]
+        with self._lock:
+            paths = {hash: self._lookup(hash) for hash in hashes}
+        missing = {}  # hash -> source path
+        for hash, wp in zip(hashes, wallpapers):
+            if paths[hash] is None:
+                missing.setdefault(hash, wp.path)
+        if missing:
+            log.debug("Creating %d thumbnails.", len(missing))
+            with self._lock:
+                if self._executor is None:
+                    # no fork, we have threads
+                    self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers,
+                            mp_context=multiprocessing.get_context("spawn"))
+                executor = self._executor
+            sizes = executor.map(make_thumbnail,
+                                 missing.values(),
+                                 map(self._path, missing),
+                                 repeat(self.size),
+                                 chunksize=16)
+            if show_progress:
+                sizes = progress(sizes, total=len(missing),
+                                 text="creating thumbnails")
+            sizes = list(sizes)
+            with self._lock:
+                for hash, size in zip(missing, sizes):
+                    if size:
+                        self._size += size - self._entries.pop(hash, 0)
+                        self._entries[hash] = size
+                        paths[hash] = self._path(hash)
+                self._evict(keep=paths.keys())
+        return [paths[hash] for hash in hashes]
+
+    def _evict(self, keep=()):
+        """Remove least recently used thumbnails, except for those in keep,
+        until the size limit is met."""
+        for hash in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if hash in keep:
+                continue
+            self._size -= self._entries.pop(hash)
+            try:
+                os.remove(self._path(hash))
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def show(paths):
+    """Open thumbnails in an image viewer, the first one shown first."""
+    paths = [path for path in paths if path]
+    if not paths:
+        return
+    try:
+        subprocess.Popen(args=("feh", "--scale-down") + tuple(paths))
+    except OSError as e:
+        log.warning("Can't show thumbnails: %s", e)
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import os
 import logging
+import threading
 
 import urwid
 from urwid import (MainLoop, ExitMainLoop, WidgetWrap,
                    Frame, Pile, Columns, ListBox, Text, Edit, Divider, AttrMap)
 
 from .util import CallbackLogHandler
+from .screen import Cycler
+from . import thumbnails
 
 __all__ = ('Ui')
 
@@ -24,6 +28,9 @@ palette = [
 _shift_number_keys = dict((key, number) for number, key
                           in enumerate('!"§$%&/()='))
 
+# number of upcoming wallpapers shown in previews
+PREVIEW_COUNT = 30
+
 class ListBoxWithTabSupport(ListBox):
     """urwid *still* doesn't support tab key for cycling focus"""
 
@@ -130,18 +137,21 @@ class ScreenWidget(WidgetWrap):
                       " [ {rating} | {purity} ]"
                       " {format} {width:d}×{height:d}")
 
-    def __init__(self, screen, screen_controller):
+    def __init__(self, screen, screen_controller, thumbnail_cache=None,
+                 cycler=None):
         self._screen = screen
         self._scrctrl = screen_controller
+        self._thumbnails = thumbnail_cache
+        self._cycler = cycler
         self._left_border = Text(" ")
-        # self._playpause = Text("⏸")
+        self._playpause = Text("▶")
         self._info = Text(self._info_template)
         self._scale = Text("")
         self._transformations = Parenthesis("")
         self._tags = Parenthesis("")
         self._top = Columns([
             (1, self._left_border),
-            # (2, self._playpause),
+            (1, self._playpause),
             ('pack', self._info),
             ('pack', self._scale),
             ('pack', self._transformations),
@@ -158,6 +168,10 @@ class ScreenWidget(WidgetWrap):
     def selectable(self):
         return True
 
+    @property
+    def editing(self):
+        return self._tags.editable
+
     def render(self, size, focus=False):
         # maybe this is better:
         # https://groups.google.com/a/excess.org/forum/#!topic/urwid/3Si0ZRKkFaw
@@ -166,6 +180,7 @@ class ScreenWidget(WidgetWrap):
 
     def update(self, *_):
         wp = self._screen.wallpaper
+        self._playpause.set_text("⏸" if self._screen.paused else "▶")
         self._info.set_text(self._info_template.format(
             collection_size=len(self._screen.wallpapers),
             rating=("☆" if wp.rating == 0 else "★·" + str(wp.rating)),
@@ -190,7 +205,8 @@ class ScreenWidget(WidgetWrap):
         if wp.transformations[1]:
             trafos.append("↕")
         self._transformations.set_text(",".join(trafos))
-        self._tags.set_text(",".join(wp.tags))
+        if not self._tags.editable:  # don't lose what's being typed
+            self._tags.set_text(",".join(wp.tags))
         self._path.set_text(wp.path)
 
     def keypress(self, size, key):
@@ -203,6 +219,13 @@ class ScreenWidget(WidgetWrap):
         wp = self._screen.wallpaper
         if key == 'delete': self._screen.wallpapers.remove_current()
         elif key == 'o': wp.open()
+        elif key == 'v' and self._thumbnails:
+            self._preview()
+            return
+        elif key == 'p' or key == ' ':
+            self._screen.paused = not self._screen.paused
+            self.update()
+            return
         elif key == 'a': self._screen.wallpapers.next()
         elif key == 'q': self._screen.wallpapers.prev()
         elif key == 's': wp.rating -= 1
@@ -253,7 +276,7 @@ class ScreenWidget(WidgetWrap):
                 self._tags.text += ","
             self._tags.editable = True
             # make sure to adjust when changing the layout:
-            self._top.focus_position = 4
+            self._top.focus_position = 5
             return
         elif key == 'enter' and self._tags.editable:
             self._tags.editable = False
@@ -265,6 +288,25 @@ class ScreenWidget(WidgetWrap):
             return key
         self.update()
         self._scrctrl.display_wallpapers()
+        self._restart_cycle()
+
+    def _restart_cycle(self):
+        """Give changes made by hand a full interval before moving on."""
+        if self._cycler:
+            self._cycler.restart(self._screen)
+
+    def _preview(self):
+        """Show thumbnails of the current and upcoming wallpapers."""
+        wallpapers = ([self._screen.wallpaper]
+                      + self._screen.wallpapers.upcoming(PREVIEW_COUNT))
+        def show():
+            try:
+                thumbnails.show(self._thumbnails.get(wallpapers))
+            except Exception as e:
+                # anything on stderr would garble the screen
+                log.warning("Previewing wallpapers failed: %s", e)
+        # creating thumbnails may take a moment
+        threading.Thread(target=show, name="preview", daemon=True).start()
 
     def mouse_event(self, size, event, button, *_):
         if event == 'mouse release':
@@ -273,18 +315,25 @@ class ScreenWidget(WidgetWrap):
             self._screen.wallpapers.prev()
             self.update()
             self._scrctrl.display_wallpapers()
+            self._restart_cycle()
         elif event == 'mouse press' and button == 5:
             self._screen.wallpapers.next()
             self.update()
             self._scrctrl.display_wallpapers()
+            self._restart_cycle()
 
 
 
 class Ui:
 
-    def __init__(self, screen_controller, wallpaper_controller):
+    def __init__(self, screen_controller, wallpaper_controller, interval=0,
+                 thumbnail_cache=None):
         self._scrctrl = screen_controller
         self._wpctrl = wallpaper_controller
+        self._thumbnails = thumbnail_cache
+        self._cycler = None
+        if interval > 0:
+            self._cycler = Cycler(screen_controller, interval)
         self._layout()
 
         self._reading_command = False
@@ -299,6 +348,10 @@ class Ui:
         # https://github.com/urwid/urwid/issues/140
         self._loop.screen.tty_signal_keys(stop='undefined')
 
+        # deliver wallpaper changes in batches whenever input is processed
+        self._loop.event_loop.enter_idle(
+                                    self._wpctrl.store.changes.publish)
+
 
     def _layout(self):
         self._wallpaper_count = Text(str(len(self._wpctrl.wallpapers)))
@@ -309,7 +362,8 @@ class Ui:
                              dividechars=1)
         header = Pile([self._head, AttrMap(Divider("─"), 'divider')])
 
-        self._screens = [ScreenWidget(screen, self._scrctrl)
+        self._screens = [ScreenWidget(screen, self._scrctrl,
+                                     self._thumbnails, self._cycler)
                          for screen in self._scrctrl.screens]
         body = ListBoxWithTabSupport(self._screens)
 
@@ -317,14 +371,46 @@ class Ui:
 
 
     def run_loop(self):
+        self._info_pipe = self._loop.watch_pipe(self._info_from_pipe)
         self._log_handler = CallbackLogHandler(self.info)
         logging.getLogger(__package__).addHandler(self._log_handler)
+        if self._cycler:
+            self._cycle()
+        self._watch_screens()
         self._loop.run()
         logging.getLogger(__package__).removeHandler(self._log_handler)
+        self._loop.remove_watch_pipe(self._info_pipe)
+
+
+    def _cycle(self, *_):
+        held = [screen_widget._screen for screen_widget in self._screens
+                if screen_widget.editing]
+        advanced, delay = self._cycler.poll(held)
+        if advanced:
+            for screen_widget in self._screens:
+                screen_widget.update()
+        self._loop.set_alarm_in(delay, self._cycle)
+
+
+    def _watch_screens(self, *_):
+        if self._scrctrl.update_screens():
+            self._screens = [ScreenWidget(screen, self._scrctrl,
+                                     self._thumbnails, self._cycler)
+                             for screen in self._scrctrl.screens]
+            self._root.body = ListBoxWithTabSupport(self._screens)
+        self._loop.set_alarm_in(self._scrctrl.probe.interval,
+                                self._watch_screens)
 
 
     def info(self, message):
-        self._info.set_text("⋮ " + str(message))
+        if threading.current_thread() is threading.main_thread():
+            self._info.set_text("⋮ " + str(message))
+        else:
+            # widgets may only be touched from the main loop
+            os.write(self._info_pipe, str(message).encode() + b"\n")
+
+    def _info_from_pipe(self, data):
+        self.info(data.decode().rstrip("\n").rsplit("\n", 1)[-1])
 
     def _start_reading_command(self):
         self._reading_command = True
@@ -355,6 +441,9 @@ class Ui:
             self._start_reading_command()
         elif key == 'ctrl s':
             self._wpctrl.save_updates()
+        elif not self._screens and (key == 'x' or key in _shift_number_keys):
+            log.info("No screens connected.")
+            return
         elif key == 'x':
             self._scrctrl.cycle_collections()
         elif key in _shift_number_keys:
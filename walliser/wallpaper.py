@@ -2,19 +2,26 @@
 
 import os
 import subprocess
-import builtins
 import logging
 from operator import attrgetter
 import random
+import heapq
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from glob import iglob as glob
+from stat import S_ISREG
 import re
 from datetime import datetime
 
 from PIL import Image
 
-from .util import (Observable, observed, observed_property,
-                   get_file_hash, parse_relative_time)
+from .util import get_file_hash, parse_relative_time
+from .store import (WallpaperStore, FIELD, ALL_FIELDS, field_mask,
+                    pack_transformations)
 from .progress import progress
+from .render import RenderRequest
+from .features import (analyze_files, COLOR_BINS, COLOR_BYTES,
+                       HISTOGRAM_OFFSET, DOMINANT_OFFSET)
 
 import warnings
 warnings.simplefilter('error', Image.DecompressionBombWarning)
@@ -42,20 +49,84 @@ def images_in_dir(root_dir):
             yield os.path.realpath(os.path.join(directory, f))
 
 
-class Wallpaper(Observable):
-    """Model representing one wallpaper"""
+def changes(*fields):
+    """Decorator for Wallpaper methods that modify the given fields.
+    Changes are recorded on the store's change bus."""
+    mask = field_mask(fields)
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            method(self, *args, **kwargs)
+            self._store.mark_changed(self._row, mask)
+        return wrapper
+    return decorator
+
+def column_property(name, default, cast=None):
+    """Property stored in the column `name` of the wallpaper's store.
+    Changes are recorded, deleting resets to default."""
+    if cast is None:
+        cast = type(default)
+    def getter(self):
+        return getattr(self._store, name)[self._row]
+    def setter(self, value):
+        getattr(self._store, name)[self._row] = cast(value)
+    def deleter(self):
+        getattr(self._store, name)[self._row] = default
+    return property(getter, changes(name)(setter), changes(name)(deleter))
+
+def color_share_property(name):
+    """Read-only share of pixels in colour bin `name` (see features.py)
+    between 0 and 1, 0 if unknown."""
+    offset = HISTOGRAM_OFFSET + COLOR_BINS.index(name)
+    def getter(self):
+        return self._store.colors[self._row * COLOR_BYTES + offset] / 255
+    return property(getter)
+
+
+class Wallpaper:
+    """Model representing one wallpaper.
+    Only a light-weight view onto one row of a WallpaperStore."""
+
+    __slots__ = ('_store', '_row')
+
+    @property
+    def hash(self):
+        return self._store.digest(self._row).hex()
+
+    @property
+    def paths(self):
+        return self._store.get_paths(self._row)
+
+    @property
+    def invalid_paths(self):
+        return self._store.invalid_paths.get(self._row, [])
 
     @property
     def path(self):
-        try:
-            return self.paths[0]
-        except IndexError:
-            return None
+        return self._store.primary_path(self._row)
 
     @property
     def mtime(self):
         return os.path.getmtime(self.path)
 
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def format(self):
+        return self._store.format_names[self._store.format[self._row]]
+
+    @property
+    def added(self):
+        return datetime.fromtimestamp(self._store.added[self._row])
+
+    @property
+    def modified(self):
+        return datetime.fromtimestamp(self._store.modified[self._row])
+
+    _width = column_property("width", 0)
+    _height = column_property("height", 0)
 
     @property
     def width(self):
@@ -65,102 +136,113 @@ class Wallpaper(Observable):
     def height(self):
         return self._width if self.transformations[2] % 180 else self._height
 
+    @property
+    def phash(self):
+        return self._store.phash[self._row]
+
+    @property
+    def duplicates(self):
+        """Other wallpapers that look almost the same."""
+        return [Wallpaper(self._store, row)
+                for row in self._store.similar_rows(self._row)]
+
+    @property
+    def luminance(self):
+        """Mean brightness between 0 and 1, 0 if unknown."""
+        return self._store.colors[self._row * COLOR_BYTES] / 255
+
+    red = color_share_property("red")
+    yellow = color_share_property("yellow")
+    green = color_share_property("green")
+    cyan = color_share_property("cyan")
+    blue = color_share_property("blue")
+    magenta = color_share_property("magenta")
+    grey = color_share_property("grey")
+
+    @property
+    def dominant(self):
+        """Most common colours as (r, g, b), most common first."""
+        colors = self._store.get_colors(self._row)
+        if colors is None:
+            return ()
+        colors = colors[DOMINANT_OFFSET:]
+        return tuple(tuple(colors[i:i + 3]) for i in range(0, len(colors), 3))
+
     @property
     def has_transformations(self):
         return (self.x_offset or self.y_offset or self.zoom != 1 or
-                any(self.transformations))
-
-    __slots__ = ('hash', 'int_hash', 'paths', 'invalid_paths',
-                 'format', '_width', '_height',
-                 'added', 'modified',
-                 '_views', '_views_incremented',
-                 '_rating', '_purity', '_tags',
-                 '_x_offset', '_y_offset', '_zoom', '_transformations')
-
-    views = observed_property("views", 0)
-    rating = observed_property("rating", 0)
-    purity = observed_property("purity", 0)
-    tags = observed_property("tags", ())
-    x_offset = observed_property("x_offset", 0)
-    y_offset = observed_property("y_offset", 0)
-    zoom = observed_property("zoom", 1.0)
-    transformations = observed_property("transformations", (False, False, 0))
-
-    def __init__(self, hash, paths, format, width, height, added, modified,
-                 invalid_paths=None, views=0, **props):
-        super().__init__()
-        self.hash = hash
-        self.int_hash = builtins.hash(int(hash, 16)) # truncated int
-        self.paths = paths
-        self.format = format
-        self._width = width
-        self._height = height
-        self.added = added
-        self.modified = modified
-        self.invalid_paths = invalid_paths or []
-        self._views = views
-        for attr, value in props.items():
-            setattr(self, attr, value)
-        self.subscribe(self)
-
-    def notify(self, *_):
-        self.modified = datetime.now()
+                self._store.transformations[self._row])
+
+    views = column_property("views", 0)
+    rating = column_property("rating", 0)
+    purity = column_property("purity", 0)
+    x_offset = column_property("x_offset", 0)
+    y_offset = column_property("y_offset", 0)
+    zoom = column_property("zoom", 1.0)
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
 
     def __repr__(self):
         return self.__class__.__name__ + ":" + self.hash
 
     def __eq__(self, other):
         if isinstance(other, Wallpaper):
-            return self.int_hash == other.int_hash
+            return self._row == other._row and self._store is other._store
         return NotImplemented
 
     def __hash__(self):
-        return self.int_hash
+        return hash(int.from_bytes(self._store.digest(self._row), 'big'))
 
     def to_json(self):
         """Dictionary representation of this object for storing.
-        Excludes path so it can be used as key.
+        Excludes hash so it can be used as key.
         """
-        # simple attributes, always present
-        data = {
-            'paths': self.paths,
-            'format': self.format,
-            'width': self._width,
-            'height': self._height,
-            'added': self.added,
-            'modified': self.modified,
-        }
-        # attributes with common defaults may not need to be stored
-        for attr in ('views', 'rating', 'purity',
-                     'x_offset', 'y_offset', 'zoom', 'transformations'):
-            try:
-                data[attr] = getattr(self, "_" + attr)
-            except AttributeError:
-                pass
-        # attributes that are mutable iterables
-        for attr in 'tags', 'invalid_paths':
-            value = getattr(self, attr)
-            if value:
-                data[attr] = value
-        return data
+        return self._store.to_json(self._row)
 
     def increment_views(self):
         """Idempotent for this session"""
-        if hasattr(self, '_views_incremented'):
+        if self._store.views_incremented[self._row]:
             return
-        self._views_incremented = True
+        self._store.views_incremented[self._row] = True
         self.views += 1
 
     def open(self):
         # subprocess.Popen(args=("/usr/bin/eog", self.path))
         subprocess.Popen(args=("feh", "--fullscreen", self.path))
 
+    @property
+    def tags(self):
+        return self._store.get_tags(self._row)
+
     @tags.setter
-    @observed
+    @changes("tags")
     def tags(self, tags):
         if isinstance(tags, str):
             tags = map(str.strip, tags.split(","))
-        self._tags = tuple(sorted(set(filter(None, tags))))
+        self._store.tags[self._row] = self._store.intern_tags(
+                                            sorted(set(filter(None, tags))))
+
+    @tags.deleter
+    @changes("tags")
+    def tags(self):
+        self._store.tags[self._row] = ()
+
+    @property
+    def transformations(self):
+        return self._store.get_transformations(self._row)
+
+    @transformations.setter
+    @changes("transformations")
+    def transformations(self, transformations):
+        self._store.transformations[self._row] = \
+                                        pack_transformations(transformations)
+
+    @transformations.deleter
+    @changes("transformations")
+    def transformations(self):
+        self._store.transformations[self._row] = 0
 
     def check_paths(self):
         invalid_paths = []
@@ -176,11 +258,9 @@ class Wallpaper(Observable):
             return False
         return True
 
-    @observed
+    @changes("paths", "invalid_paths")
     def _invalidate_path(self, path):
-        self.paths.remove(path)
-        if path not in self.invalid_paths:
-            self.invalid_paths.append(path)
+        self._store.invalidate_path(self._row, path)
         log.debug("Invalidated wallpaper path '%s' (%s remaining).",
                   path, len(self.paths))
 
@@ -210,38 +290,215 @@ class Wallpaper(Observable):
         new_trafos = not hori, vert, rot
         self.transformations = self._simple_trans.get(new_trafos, new_trafos)
 
-    def transformed(self, screen_width=1920, screen_height=1080):
-        if not self.has_transformations:
-            return self.path
-        unique_hash = hash((self, self.x_offset, self.y_offset, self.zoom,
-                            self.transformations))
-        path = "/tmp/walliser_{:x}.{:s}".format(unique_hash,
-                                    'jpg' if self.format == 'JPEG' else 'png')
-        if os.path.isfile(path):
-            log.debug("Found transformed '%s'", path)
-            return path
-        with Image.open(self.path) as img:
-            log.debug("Creating transformed '%s'", path)
-            horizontal, vertical, rotate = self.transformations
-            if horizontal:
-                img = img.transpose(Image.FLIP_LEFT_RIGHT)
-            if vertical:
-                img = img.transpose(Image.FLIP_TOP_BOTTOM)
-            if rotate:
-                img = img.rotate(rotate, expand=True)
-            scale = self.zoom * max(screen_width / img.width,
-                                    screen_height / img.height)
-            if scale != 1:
-                img = img.resize((int(img.width * scale),
-                                  int(img.height * scale)),
-                                 resample=Image.LANCZOS)
-            left = (img.width - screen_width) / 2 + self.x_offset
-            top = (img.height - screen_height) / 2 + self.y_offset
-            img = img.crop((left, top, left + screen_width,
-                                       top + screen_height))
-            img.save(path)
-        return path
+    def transformed(self, screen_width, screen_height, cache, variants=None,
+                    canvas=None, count=False):
+        """Path of this wallpaper as it should be displayed on a screen of
+        the given size, or the RenderRequest to render it through cache if
+        that hasn't been done yet. Without transformations that's a
+        pre-rendered variant if variants has one, otherwise the original.
+        canvas is the screen's part of all screens in span mode.
+        Only counts cache hits if asked to."""
+        request = RenderRequest.of(self, screen_width, screen_height, canvas)
+        if not self.has_transformations and not canvas:
+            return variants and variants.lookup(request) or self.path
+        return cache.lookup(request, count=count) or request
+
+
+# Sort keys that require disk access, mapped to their os.stat_result attribute
+_stat_sort_keys = {"mtime": "st_mtime", "size": "st_size"}
+
+def _stat_batch(paths, attribute):
+    keys = []
+    for path in paths:
+        try:
+            keys.append(getattr(os.stat(path), attribute))
+        except OSError:
+            keys.append(0)
+    return keys
+
+def stat_sort_keys(wallpapers, attribute, workers=16, batch_size=256):
+    """Stat the primary paths of all wallpapers in batches on a thread pool
+    and return the requested stat attribute in the same order."""
+    paths = [wp.path for wp in wallpapers]
+    batches = [paths[i:i + batch_size]
+               for i in range(0, len(paths), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [key for keys in executor.map(_stat_batch, batches,
+                                             [attribute] * len(batches))
+                    for key in keys]
+
+def sort_wallpapers(wallpapers, key, reverse=False, limit=None):
+    """Sort wallpapers by attribute `key`. If `limit` is given only the first
+    `limit` wallpapers are selected using a heap, which is O(n log limit).
+    Keys that require disk access are prefetched in one parallel pass."""
+    if key in _stat_sort_keys:
+        keys = stat_sort_keys(wallpapers, _stat_sort_keys[key])
+    else:
+        keys = map(attrgetter(key), wallpapers)
+    # decorate with index so wallpapers themselves are never compared
+    decorated = zip(keys, range(len(wallpapers)), wallpapers)
+    if limit is None:
+        decorated = sorted(decorated, reverse=reverse)
+    elif reverse:
+        decorated = heapq.nlargest(limit, decorated)
+    else:
+        decorated = heapq.nsmallest(limit, decorated)
+    return [wp for _, _, wp in decorated]
+
+
+def check_paths(wallpapers):
+    """Like Wallpaper.check_paths for many wallpapers at once.
+    File system checks are grouped by directory so there is one scandir call
+    per directory instead of two syscalls per path.
+    Returns a list of wallpapers that still have valid paths."""
+    wallpapers = list(wallpapers)
+    invalidate_paths(find_invalid_paths(wallpapers))
+    valid = []
+    for wp in wallpapers:
+        if wp.paths:
+            valid.append(wp)
+        else:
+            log.warning("No valid paths left for wallpaper '%s'", wp.hash)
+    return valid
+
+def _per_directory(wallpapers, check, workers, show_progress, text):
+    """Run check(store, directory, [(row, file name), ...]) for every
+    directory containing wallpapers on a number of worker threads and
+    concatenate the resulting lists."""
+    wallpapers = list(wallpapers)
+    if not wallpapers:
+        return []
+    store = wallpapers[0]._store
+    rows = (wp._row for wp in wallpapers)
+    directories = list(store.rows_by_directory(rows).items())
+    def check_directory(directory_id_and_entries):
+        directory_id, entries = directory_id_and_entries
+        return check(store, store.directories[directory_id], entries)
+    found = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(check_directory, directories)
+        if show_progress:
+            results = progress(results, total=len(directories), text=text)
+        for directory_found in results:
+            found += directory_found
+    return found
+
+def find_invalid_paths(wallpapers, workers=1, show_progress=False,
+                       min_listed=1):
+    """[(wallpaper, path), ...] of paths that no longer exist, grouped by
+    directory with one scandir each, on a number of worker threads.
+    Directories with fewer than min_listed of the paths are checked file by
+    file instead, listing a large directory for a few files costs more.
+    Only reads, so this may run on any thread while changes to the store
+    are left to the caller (see invalidate_paths)."""
+    def check(store, directory, entries):
+        files = None
+        if len(entries) >= min_listed:
+            files = _list_files(directory)
+        invalid = []
+        for row, name in entries:
+            path = os.path.join(directory, name)
+            if files is None:  # can't tell from the listing, look at the file
+                missing = _stat_file(path) is False
+            else:
+                missing = name not in files
+            if missing:
+                invalid.append((Wallpaper(store, row), path))
+        return invalid
+    return _per_directory(wallpapers, check, workers, show_progress,
+                          "checking directories")
+
+def find_modified_paths(wallpapers, workers=1, show_progress=False):
+    """Compare files against the size stored for their wallpaper and the
+    time it was last verified (or added). Returns a list of
+    (wallpaper, path, size, suspicious) for all existing files, where
+    suspicious files may have changed and need to be hashed again.
+    Missing files are left to maintenance."""
+    def check(store, directory, entries):
+        stats = _stat_files(directory)
+        if stats is None:
+            stats = {name: _stat_file(os.path.join(directory, name))
+                     for _, name in entries}
+        found = []
+        for row, name in entries:
+            stat = stats.get(name)
+            if not stat:
+                continue
+            size = store.file_size[row]
+            verified = store.verified[row] or store.added[row]
+            suspicious = (size and stat.st_size != size
+                          or int(stat.st_mtime) > verified)
+            found.append((Wallpaper(store, row), os.path.join(directory, name),
+                          stat.st_size, suspicious))
+        return found
+    return _per_directory(wallpapers, check, workers, show_progress,
+                          "comparing files")
+
+def hash_files(paths, workers=1, show_progress=False):
+    """Hashes of files, None for those that can't be read."""
+    def hash_file(path):
+        try:
+            return get_file_hash(path)
+        except OSError as e:
+            log.warning("Can't read '%s': %s", path, e)
+            return None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(hash_file, paths)
+        if show_progress:
+            hashes = progress(hashes, total=len(paths), text="hashing files")
+        return list(hashes)
+
+def invalidate_paths(invalid):
+    """Record [(wallpaper, path), ...] as found by find_invalid_paths."""
+    for wp, path in invalid:
+        wp._invalidate_path(path)
+
+def _list_files(directory):
+    """Names of all regular files in a directory (following symlinks),
+    empty if the directory doesn't exist and None if it can't be listed."""
+    entries = _scan_directory(directory)
+    if entries is None:
+        return None
+    return {entry.name for entry in entries if entry.is_file()}
+
+def _stat_files(directory):
+    """{name: stat result} of all regular files in a directory, like
+    _list_files."""
+    entries = _scan_directory(directory)
+    if entries is None:
+        return None
+    return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+
+def _scan_directory(directory):
+    """List of directory entries, see _list_files."""
+    try:
+        with os.scandir(directory) as entries:
+            return list(entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    except PermissionError:
+        log.warning("No permission to read directory '%s'", directory)
+    except OSError as e:
+        log.warning("Can't read directory '%s': %s", directory, e)
+    return None
+
+def _stat_file(path):
+    """Stat result of a regular file, False if there is none and None if
+    that can't be told (e.g. without permission)."""
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    except OSError:
+        return None
+    return stat if S_ISREG(stat.st_mode) else False
+
 
+# query attributes that need images to be analyzed first
+# queries name features of the image content like `image.blue`
+FEATURE_PREFIX = "image."
+_feature_query = (r"\bwp\.(duplicates|luminance|dominant|{})\b"
+                  .format("|".join(COLOR_BINS)))
 
 def make_query(expression):
     """Turn an expression into a function, assigning Wallpaper properties to
@@ -251,7 +508,10 @@ def make_query(expression):
                   "width", "height", "format",
                   "added", "modified",
                   "x_offset", "y_offset", "zoom", "transformations")
-    builtins = {"min": min, "max": max, "sum": sum, "map": map,
+    # features of the image content live in their own namespace so they
+    # don't shadow tags like "blue"
+    features = ("duplicates", "luminance", "dominant") + COLOR_BINS
+    builtins = {"min": min, "max": max, "sum": sum, "map": map, "len": len,
                 "int": int, "bool": bool, "str": str, "repr": repr,
                 "parse_relative_time": parse_relative_time}
     keywords = set(builtins) | {"and", "or", "not", "lambda",
@@ -262,6 +522,12 @@ def make_query(expression):
         word = match.group(0)
         if word in keywords:
             return word
+        if word.startswith(FEATURE_PREFIX):
+            name = word[len(FEATURE_PREFIX):]
+            for attr in features:
+                if attr.startswith(name):
+                    return "wp." + attr
+            raise SyntaxError("Unknown image feature `{}`.".format(word))
         for attr in attributes:
             if attr.startswith(word):
                 return "wp." + attr
@@ -269,7 +535,8 @@ def make_query(expression):
             return f"parse_relative_time('{word[1:]}')"
         return f"('{word}' in wp.tags)"
 
-    expression = re.sub(r"[A-Za-z][A-Za-z0-9_]*", replacer, expression)
+    expression = re.sub(r"(?:{})?[A-Za-z][A-Za-z0-9_]*".format(
+                            re.escape(FEATURE_PREFIX)), replacer, expression)
     definition = "lambda wp: bool({})".format(expression)
     try:
         # Let's hope this is safe. Mainly guard against accidents.
@@ -283,10 +550,12 @@ class WallpaperController:
     """Manages a collection of relevant wallpapers and takes care of some
     config related IO (TODO: isolate the IO)."""
 
-    def __init__(self, config, sources=None, query="True", sort=None, reverse=False):
+    def __init__(self, config, sources=None, query="True", sort=None,
+                 reverse=False, limit=None):
         self._config = config
-        self._updated_wallpapers = set()
         self._updates_saved = 0
+        self._deleted = set()
+        self.sort = sort
 
         self.wallpapers = []
 
@@ -294,24 +563,37 @@ class WallpaperController:
             config_data = config["wallpapers"]
         except (TypeError, KeyError):
             config_data = {}
+        if isinstance(config_data, WallpaperStore):
+            self.store = config_data
+        else:
+            self.store = self.store_from_config(config_data)
+            # from here on the store is what gets saved
+            config["wallpapers"] = self.store
 
         query, query_expression = make_query(query)
         log.debug("Using query `%s`", query_expression)
 
         if sources:
-            wallpapers = self.wallpapers_from_paths(sources, config_data)
+            added = []
+            wallpapers = list(self.wallpapers_from_paths(sources, added))
+            if self.store.changes.unsaved_count:
+                log.info("Found %d new wallpapers.",
+                         self.store.changes.unsaved_count)
+            # analyzed once when added, unless that would be thrown away
+            if not config.readonly:
+                self.add_features(added, show_progress=True)
         else:
-            wallpapers = (Wallpaper(hash=hash, **data)
-                          for hash, data in config_data.items()
-                          if data['paths'])
-
-        self.wallpapers = []
-        for wp in set(filter(query, wallpapers)):
-            wp.subscribe(self)
-            self.wallpapers.append(wp)
-
-        if self._updated_wallpapers:
-            log.info("Found %d new wallpapers.", len(self._updated_wallpapers))
+            wallpapers = [Wallpaper(self.store, row)
+                          for row in self.store.rows()
+                          if self.store.paths[row]]
+        if re.search(_feature_query, query_expression):
+            # all of them, duplicates may be anywhere, not just in sources
+            self.add_features((Wallpaper(self.store, row)
+                              for row in self.store.rows()
+                              if self.store.paths[row]),
+                             show_progress=True)
+
+        self.wallpapers = list(set(filter(query, wallpapers)))
 
         if not self.wallpapers:
             raise Exception('No matching wallpapers found. Query: "' + query_expression + '"')
@@ -320,64 +602,144 @@ class WallpaperController:
 
         if sort:
             log.debug(f"sorting by {sort}")
-            self.wallpapers.sort(key=attrgetter(sort), reverse=reverse)
+            self.wallpapers = sort_wallpapers(self.wallpapers, sort,
+                                              reverse=reverse, limit=limit)
+        elif limit is not None:
+            self.wallpapers = random.sample(self.wallpapers,
+                                            min(limit, len(self.wallpapers)))
         else:
             random.shuffle(self.wallpapers)
 
-    def wallpapers_from_paths(self, sources, config_data={}):
-        """Iterate wallpapers in given paths, including new ones."""
-        known_paths = {path: hash for hash, data in config_data.items()
-                                    for path in data["paths"] }
+    def store_from_config(self, config_data):
+        """Move wallpaper data from the config into a compact store."""
+        store = WallpaperStore()
+        now = datetime.now()
+        for hash, data in config_data.items():
+            if not {"paths", "format", "width", "height"} <= data.keys():
+                log.warning("Skipping incomplete wallpaper entry '%s'", hash)
+                continue
+            # check for outdated data formatting
+            updated = False
+            if "added" not in data:
+                updated = True
+                data["added"] = data["modified"] = now
+            row = store.add(hash, **data)
+            if updated:
+                store.changes.mark(row, ALL_FIELDS)
+        return store
+
+    def wallpapers_from_paths(self, sources, added=None):
+        """Iterate wallpapers in given paths, including new ones.
+        Wallpapers that weren't known before are also appended to added."""
+        known_paths = self.store.path_index()
         now = datetime.now()
         for path in progress(set(find_images(sources))):
-            if path in known_paths:
-                hash = known_paths[path]
-                data = config_data[hash]
-                # check for outdated data formatting
-                updated = False
-                if "added" not in data:
-                    updated = True
-                    data["added"] = data["modified"] = now
+            split_path = self.store.split_path(path)
+            if split_path in known_paths:
+                row = known_paths[split_path]
             else: # new path
-                updated = True
                 try:
                     img = Image.open(path) # Do this first to abort immediately
                                            # for non-images.
                     hash = get_file_hash(path)
-                    if hash in config_data:
+                    if hash in self.store:
                         log.debug("Adding path of know wallpaper '%s'", path)
-                        data = config_data[hash].copy()
-                        data["paths"].append(path)
-                        data["paths"].sort()
+                        fields = FIELD["paths"]
                     else:  # new file
                         log.debug("Added new wallpaper '%s'", path)
-                        data = {
-                            "paths": [path],
-                            "format": img.format,
-                            "width": img.size[0],
-                            "height": img.size[1],
-                            "added": now,
-                            "modified": now,
-                        }
+                        fields = ALL_FIELDS
+                    row = self.store.add(hash,
+                                         paths=[path],
+                                         format=img.format,
+                                         width=img.size[0],
+                                         height=img.size[1],
+                                         added=now,
+                                         modified=now,
+                                         file_size=os.path.getsize(path),
+                                         verified=now)
                 except IOError:
                     log.warning("Can't open '%s'", path)
                     continue
-            wp = Wallpaper(hash=hash, **data)
-            if updated:
-                self._updated_wallpapers.add(wp)
-            yield wp
-
-    def notify(self, wallpaper, *_):
-        self._updated_wallpapers.add(wallpaper)
+                self.store.changes.mark(row, fields)
+                if fields == ALL_FIELDS and added is not None:
+                    added.append(Wallpaper(self.store, row))
+            yield Wallpaper(self.store, row)
+
+    def add_features(self, wallpapers, show_progress=False):
+        """Analyze images of wallpapers whose features are unknown."""
+        # once per wallpaper, not per path
+        missing = list({wp._row: wp for wp in wallpapers
+                        if self.store.get_colors(wp._row) is None}.values())
+        if not missing:
+            return
+        log.debug("Analyzing %d images.", len(missing))
+        features = analyze_files([wp.path for wp in missing],
+                                 show_progress=show_progress)
+        for wp, (phash, colors) in zip(missing, features):
+            if phash:
+                self.store.set_phash(wp._row, phash)
+            if colors:
+                self.store.set_colors(wp._row, colors)
+
+    def sign(self, wp, size):
+        """Remember that wp's content (of given file size) was verified."""
+        self.store.file_size[wp._row] = size
+        self.store.verified[wp._row] = datetime.now().timestamp()
+        self.store.changes.mark(wp._row, field_mask(("file_size", "verified")))
+
+    def move_path(self, wp, path, hash, size):
+        """The file at path no longer has wp's content but hash. Move the
+        path to the wallpaper with that hash, created from wp's data if
+        it isn't known yet. wp is deleted when it has no paths left."""
+        now = datetime.now()
+        with Image.open(path) as img:
+            data = dict(paths=[path], format=img.format,
+                        width=img.size[0], height=img.size[1])
+        old = self.store.to_json(wp._row)
+        same_size = (old["width"], old["height"]) == (data["width"],
+                                                      data["height"])
+        for key in ("views", "rating", "purity", "tags") + (
+                    ("x_offset", "y_offset", "zoom", "transformations")
+                    if same_size else ()):
+            if key in old:
+                data[key] = old[key]
+        new = hash not in self.store
+        row = self.store.add(hash, added=old["added"], modified=now,
+                             file_size=size, verified=now, **data)
+        self.store.changes.mark(row, ALL_FIELDS if new else FIELD["paths"])
+        self.store.remove_path(wp._row, path)
+        self.store.mark_changed(wp._row, FIELD["paths"])
+        if not wp.paths:
+            self.delete([wp])
+        return Wallpaper(self.store, row)
+
+    def delete(self, wallpapers):
+        """Forget wallpapers entirely. Takes effect with save_updates."""
+        for wp in wallpapers:
+            del self.store[wp.hash]
+            self._deleted.add(wp.hash)
+        self.wallpapers = [wp for wp in self.wallpapers
+                           if wp.hash in self.store]
 
     def save_updates(self):
-        if not self._updated_wallpapers:
+        """Save changed wallpapers. Only changed fields are serialised
+        for merging if the config file was modified in the meantime."""
+        changes = self.store.changes.take_unsaved()
+        updates = {}
+        partial = set()
+        for row, fields in changes.items():
+            hash = self.store.digest(row).hex()
+            if hash in self.store:  # not deleted
+                updates[hash] = self.store.to_json(row, fields)
+                if fields != ALL_FIELDS:
+                    partial.add(hash)
+        deleted, self._deleted = self._deleted, set()
+        if not updates and not deleted:
             return
-        updates_count = len(self._updated_wallpapers)
-        self._config["wallpapers"].update((wp.hash, wp.to_json())
-                                         for wp in self._updated_wallpapers)
-        self._config.save()
-        self._updated_wallpapers = set()
+        updates_count = len(updates) + len(deleted)
+        self._config.save(updates={"wallpapers": updates},
+                          deletes={"wallpapers": deleted},
+                          partial={"wallpapers": partial})
         self._updates_saved += updates_count
         log.info("%d update%s %ssaved (%d total)",
                  updates_count,